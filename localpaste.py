@@ -6,8 +6,13 @@
 # To send input:   echo -n "hello" | curl -F 'clbin=<-' http://localhost:6542
 # To get pastes:   curl http://localhost:6542/XXXX
 #
+# To make a paste expire in an hour:   echo -n "hello" | curl -F 'clbin=<-' 'http://localhost:6542/?ttl=3600'
+# To send several files:   curl -F 'a=@a.txt' -F 'b=@b.txt' 'http://localhost:6542/?multi=1'
+#                     or:   tar cf - *.log | curl --data-binary @- -H 'Content-Type: application/x-tar' http://localhost:6542
+# To get several pastes:    curl 'http://localhost:6542/?names=XXXX,YYYY' | tar xf -
+# To view a paste in a browser, with line numbers and syntax highlighting:   http://localhost:6542/XXXX.html
+#
 # What it does not do:
-#    - clean up old files (a simple cronjob can do this: find localpaste_data -type f -mtime +30 -delete)
 #    - remove files on request (would need to log some authentication info for that... ip address, cookie, etc., or output a 2nd url with special privs)
 #
 # Copyright 2015 Peter Maloney
@@ -33,53 +38,79 @@ import argparse
 import datetime
 import time
 import hashlib
-import base64
 import os
 import http.server
 import re
 import socket
-from urllib.parse import parse_qs
+import queue
+import threading
+import signal
+import tempfile
+import mmap
+import collections
+import secrets
+import string
+import heapq
+import gzip
+import struct
+import asyncio
+import io
+import http.client
+import email.utils
+import email.message
+import bisect
+import math
+import json
+import html
+import tarfile
+import fcntl
+import subprocess
+import concurrent.futures
+from urllib.parse import unquote_plus, unquote_to_bytes, urlsplit, parse_qs
 
 # more imports are below, based on usage of command line arguments, for modules:
 #    ssl
 #    pwd
 #    grp
+#    sqlite3
+#    pygments
 
 debug = 0
 
-# http://stackoverflow.com/questions/24575121/in-python-how-to-print-full-iso-8601-timestamp-including-current-timezone
+# The timestamp only changes once a second, so it is only worked out once a second: (second, timestamp)
+timestamp_cache = (None, None)
+
 def get_timestamp_str():
-    # get current local time and utc time
-    localnow = datetime.datetime.now()
-    utcnow = datetime.datetime.utcnow()
-
-    # compute the time difference in seconds
-    tzd = localnow - utcnow
-    secs = tzd.days * 24 * 3600 + tzd.seconds
-
-    # get a positive or negative prefix
-    prefix = '+'
-    if secs < 0:
-        prefix = '-'
-        secs = abs(secs)
-
-    # print the local time with the difference, correctly formatted
-    suffix = "%s%02d:%02d" % (prefix, secs/3600, secs/60%60)
-    now = localnow.replace(microsecond=0)
-    timestamp = "%s%s" % (now.isoformat(' '), suffix)
+    global timestamp_cache
+    now = int(time.time())
+    second, timestamp = timestamp_cache
+    if second != now:
+        # the local time with the timezone offset, like 2015-06-01 12:00:00+02:00
+        timestamp = datetime.datetime.fromtimestamp(now).astimezone().isoformat(' ')
+        timestamp_cache = (now, timestamp)
     return timestamp
     
+# Once the log writer thread is started (see LogWriter), log lines are queued for it instead of being written
+# by the thread that logs them, so a slow stdout or log file never holds up a request.
+log_writer = None
+
+def write_log(line, stream=None):
+    if log_writer is not None:
+        log_writer.put((stream or sys.stdout, line))
+    else:
+        (stream or sys.stdout).write(line + "\n")
+
 def log(message):
     timestamp = get_timestamp_str()
-    print("%s: %s" % (timestamp, message))
+    write_log("%s: %s" % (timestamp, message))
     
 def logwarn(message):
     timestamp = get_timestamp_str()
-    print("%s: WARNING: %s" % (timestamp, message))
+    write_log("%s: WARNING: %s" % (timestamp, message))
     
 def logerror(message):
     timestamp = get_timestamp_str()
-    print("%s: ERROR: %s" % (timestamp, message))
+    write_log("%s: ERROR: %s" % (timestamp, message))
     
 def logdebug(args):
     if debug != 1:
@@ -117,7 +148,32 @@ parser.add_argument('--name-max-size', action='store',
                    help='maximum number of chars in the name that goes in the url and filename (default=20; do not use a number larger than 20)')
 parser.add_argument('--data-max-size', action='store',
                    type=int, default=10*1024*1024,
-                   help='maximum size in bytes for input data (default=10MiB)')
+                   help='maximum size in bytes for input data; uploads are streamed to disk, so this does not limit memory use (default=10MiB)')
+parser.add_argument('--rate-limit-requests', action='store',
+                   type=float, default=0,
+                   help='requests per second allowed from each client address, in each process; others get 429 Too Many Requests; 0 for no limit (default=0)')
+parser.add_argument('--rate-limit-burst', action='store',
+                   type=int, default=20,
+                   help='requests a client can make at once before --rate-limit-requests applies (default=20)')
+parser.add_argument('--rate-limit-bytes', action='store',
+                   type=int, default=0,
+                   help='upload bytes per second allowed from each client address, in each process; an upload may go over it, but then the client waits until it is paid back; 0 for no limit (default=0)')
+parser.add_argument('--max-upload-bytes-in-flight', action='store',
+                   type=int, default=0,
+                   help='total Content-Length of the uploads each process reads at once; others get 503 Service Unavailable before their body is read; 0 for no limit (default=0)')
+parser.add_argument('--batch-max-pastes', action='store',
+                   type=int, default=100,
+                   help='most pastes in one upload with ?multi=1 or a tar file, or in one batch download (default=100)')
+parser.add_argument('--layout', action='store',
+                   type=str, default="flat", choices=["flat", "sharded"],
+                   help='how pastes are arranged in the datadir: flat puts every file in the datadir itself, sharded spreads them over 2 levels of subdirectories (like ab/cd/NAME) to keep directories small (default=flat)')
+parser.add_argument('--migrate-layout', action='store_const', const=True,
+                   help='move the pastes in the datadir into the layout given by --layout, then exit; do not run this while a server is using the datadir')
+parser.add_argument('--bench-generate-name', action='store',
+                   type=int, default=None, metavar='COUNT',
+                   help='load the names in the datadir, time COUNT calls of generate_name, print the results and exit; only the index of the datadir is written, if it has none (used by localpaste_bench.py)')
+parser.add_argument('--rebuild-index', action='store_const', const=True,
+                   help='find the pastes by reading the whole datadir instead of loading its index, and write a new index; use this after pastes were added or removed by hand')
 parser.add_argument('--no-create-datadir', action='store_const', const=True,
                    help='prevent automatically creating a data dir if one does not exist')
 parser.add_argument('--user', action='store',
@@ -135,10 +191,80 @@ parser.add_argument('--hostname', action='store',
                    help='hostname to send to clients in the url so they can retrieve their paste (default=use host and port from http request)')
 parser.add_argument('--certfile', action='store',
                    type=str, default="server.pem",
-                   help='file containing both the SSL certificate and key for https (default=server.pem)')
+                   help='file containing both the SSL certificate and key for https; it is loaded again on SIGHUP, so it must stay readable after --user (default=server.pem)')
+parser.add_argument('--ssl-ciphers', action='store',
+                   type=str, default=None,
+                   help='OpenSSL cipher list for TLS 1.2, like "ECDHE+AESGCM:ECDHE+CHACHA20" (default=the OpenSSL defaults)')
+parser.add_argument('--ssl-session-tickets', action='store',
+                   type=int, default=2,
+                   help='TLS session tickets sent to each client, so its next connections can skip most of the handshake; 0 to turn them off (default=2)')
+parser.add_argument('--keep-alive-timeout', action='store',
+                   type=float, default=5,
+                   help='seconds an idle connection is kept open for another request; with the threaded engine, each one holds a worker thread (default=5)')
+parser.add_argument('--drain-timeout', action='store',
+                   type=float, default=30,
+                   help='on SIGTERM, stop accepting connections, and wait this many seconds at most for the requests being handled to finish (default=30)')
 parser.add_argument('--listen-address', action='store',
                    type=str, default="0.0.0.0",
                    help='listen address (default=0.0.0.0)')
+parser.add_argument('--expire-days', action='store',
+                   type=float, default=0,
+                   help='delete pastes this many days after they were saved; a ttl=SECONDS query parameter on the POST url can make a paste expire sooner; 0 keeps pastes forever unless they have a ttl (default=0)')
+parser.add_argument('--expire-rate', action='store',
+                   type=float, default=100,
+                   help='maximum number of expired pastes deleted per second, to keep cleanup from hogging the disk (default=100)')
+parser.add_argument('--compress', action='store',
+                   type=str, default="none", choices=["none", "gzip", "zstd"],
+                   help='compress new pastes on disk; clients that accept the same Content-Encoding get the stored data as is, others get it decompressed; zstd needs the zstandard module (default=none)')
+parser.add_argument('--storage', action='store',
+                   type=str, default="directory", choices=["directory", "sqlite"],
+                   help='directory stores each paste as a file; sqlite stores pastes up to --storage-small-size bytes in one database file, DATADIR/.pastes.sqlite, and bigger ones as files (default=directory)')
+parser.add_argument('--storage-small-size', action='store',
+                   type=int, default=64*1024,
+                   help='largest paste in bytes, before compression, stored in the database with --storage sqlite; these are not deduplicated by --dedup (default=65536)')
+parser.add_argument('--dedup', action='store_const', const=True,
+                   help='store identical pastes only once; each name is a hard link to a shared copy, which is removed with the last name')
+parser.add_argument('--cache-bytes', action='store',
+                   type=int, default=64*1024*1024,
+                   help='memory in bytes used by each process to cache recently read pastes; 0 disables the cache (default=64MiB)')
+parser.add_argument('--cache-max-object-size', action='store',
+                   type=int, default=1024*1024,
+                   help='pastes larger than this many bytes are not cached and are sent straight from disk (default=1MiB)')
+parser.add_argument('--render-cache-bytes', action='store',
+                   type=int, default=32*1024*1024,
+                   help='memory in bytes used by each process to cache the html views of pastes; 0 disables the cache (default=32MiB)')
+parser.add_argument('--render-page-bytes', action='store',
+                   type=int, default=128*1024,
+                   help='the html view of a larger paste is split into pages of about this many bytes, which are rendered when they are asked for (default=128KiB)')
+parser.add_argument('--no-highlight', action='store_const', const=True,
+                   help='show the html view of pastes without syntax highlighting, even if the pygments module is installed')
+parser.add_argument('--engine', action='store',
+                   type=str, default="threaded", choices=["threaded", "asyncio"],
+                   help='server engine: threaded uses http.server with one worker thread per connection; asyncio handles many connections in one thread with HTTP/1.1 keep-alive, and does disk I/O in the worker threads (default=threaded)')
+parser.add_argument('--access-log', action='store',
+                   type=str, default=None,
+                   help='write one line per request to this file instead of stderr; it is opened before dropping privileges, but rotating it needs its directory to be writable by --user (default=stderr)')
+parser.add_argument('--access-log-format', action='store',
+                   type=str, default="combined", choices=["combined", "json"],
+                   help='format of the --access-log lines: the apache combined log format, or one JSON object per line (default=combined)')
+parser.add_argument('--access-log-max-bytes', action='store',
+                   type=int, default=100*1024*1024,
+                   help='rotate the --access-log when it is bigger than this; 0 to never rotate (default=100MiB)')
+parser.add_argument('--access-log-backups', action='store',
+                   type=int, default=5,
+                   help='number of rotated --access-log files to keep, as FILE.1 to FILE.N (default=5)')
+parser.add_argument('--metrics-port', action='store',
+                   type=int, default=None,
+                   help='serve prometheus metrics on http://METRICS_ADDRESS:METRICS_PORT/metrics; with --processes, each process uses the next port, starting at this one; it is opened after dropping privileges, so it should be above 1024 (default=no metrics)')
+parser.add_argument('--metrics-address', action='store',
+                   type=str, default="127.0.0.1",
+                   help='listen address for --metrics-port (default=127.0.0.1)')
+parser.add_argument('--workers', action='store',
+                   type=int, default=16,
+                   help='number of worker threads handling requests in each process; 0 starts a new thread per request (default=16)')
+parser.add_argument('--processes', action='store',
+                   type=int, default=1,
+                   help='number of pre-forked processes sharing the listening socket (default=1)')
 
 args = parser.parse_args()
 debug = args.debug
@@ -146,15 +272,42 @@ logdebug("debug         = %s" % args.debug)
 logdebug("foreground    = %s" % args.foreground)
 logdebug("daemon        = %s" % args.daemon)
 logdebug("datadir       = %s" % args.datadir)
+logdebug("layout        = %s" % args.layout)
 logdebug("name-min-size = %s" % args.name_min_size)
 logdebug("name-max-size = %s" % args.name_max_size)
 logdebug("data-max-size = %s" % args.data_max_size)
+logdebug("batch-max-pastes = %s" % args.batch_max_pastes)
+logdebug("rate-limit-requests = %s" % args.rate_limit_requests)
+logdebug("rate-limit-burst = %s" % args.rate_limit_burst)
+logdebug("rate-limit-bytes = %s" % args.rate_limit_bytes)
+logdebug("max-upload-bytes-in-flight = %s" % args.max_upload_bytes_in_flight)
 logdebug("user          = %s" % args.user)
 logdebug("port          = %s" % args.port)
 logdebug("scheme        = %s" % args.scheme)
 logdebug("hostname      = %s" % args.hostname)
 logdebug("certfile      = %s" % args.certfile)
+logdebug("ssl-ciphers   = %s" % args.ssl_ciphers)
+logdebug("ssl-session-tickets = %s" % args.ssl_session_tickets)
+logdebug("keep-alive-timeout = %s" % args.keep_alive_timeout)
+logdebug("drain-timeout = %s" % args.drain_timeout)
 logdebug("listen-address= %s" % args.listen_address)
+logdebug("expire-days   = %s" % args.expire_days)
+logdebug("expire-rate   = %s" % args.expire_rate)
+logdebug("compress      = %s" % args.compress)
+logdebug("storage       = %s" % args.storage)
+logdebug("storage-small-size = %s" % args.storage_small_size)
+logdebug("dedup         = %s" % args.dedup)
+logdebug("cache-bytes   = %s" % args.cache_bytes)
+logdebug("cache-max-object-size = %s" % args.cache_max_object_size)
+logdebug("engine        = %s" % args.engine)
+logdebug("access-log    = %s" % args.access_log)
+logdebug("access-log-format = %s" % args.access_log_format)
+logdebug("access-log-max-bytes = %s" % args.access_log_max_bytes)
+logdebug("access-log-backups = %s" % args.access_log_backups)
+logdebug("metrics-port  = %s" % args.metrics_port)
+logdebug("metrics-address = %s" % args.metrics_address)
+logdebug("workers       = %s" % args.workers)
+logdebug("processes     = %s" % args.processes)
 logdebug("argv          = %s" % sys.argv)
 
 if not args.no_create_datadir and not os.path.isdir(args.datadir):
@@ -166,6 +319,32 @@ elif args.no_create_datadir and not os.path.isdir(args.datadir):
 if args.port == None:
     args.port = 80
         
+if args.compress == "zstd":
+    try:
+        import zstandard
+    except ImportError:
+        logerror("--compress zstd needs the zstandard module, eg.: pip install zstandard")
+        exit(1)
+
+# pygments is optional: without it, the html view of a paste has line numbers, but no highlighting
+pygments = None
+if not args.no_highlight:
+    try:
+        import pygments
+        import pygments.formatters
+        import pygments.lexers
+        import pygments.util
+    except ImportError:
+        logdebug("the pygments module is not installed, so pastes are not highlighted")
+        pygments = None
+
+if args.storage == "sqlite":
+    try:
+        import sqlite3
+    except ImportError:
+        logerror("--storage sqlite needs python built with the sqlite3 module")
+        exit(1)
+
 if args.scheme == "https":
     import ssl
     if not os.path.isfile(args.certfile):
@@ -189,13 +368,29 @@ if args.hostname:
 # For supporting binary files... not sure if there's any disadvantage.
 data_encoding = "latin1"
 
-if not args.foreground and not args.daemon:
+if not args.foreground and not args.daemon and not args.migrate_layout and args.bench_generate_name is None:
     logwarn("using default mode, which is currently foreground, but may change in the future")
     args.foreground = True
     
 if args.name_max_size < 20:
     logerror("name_max_size cannot be larger than 20")
     exit(1)
+
+if args.workers < 0:
+    logerror("workers cannot be negative")
+    exit(1)
+
+if args.processes < 1:
+    logerror("processes must be at least 1")
+    exit(1)
+
+if args.bench_generate_name is not None and args.bench_generate_name < 1:
+    logerror("bench-generate-name needs a COUNT of at least 1")
+    exit(1)
+
+if args.expire_days < 0 or args.expire_rate <= 0:
+    logerror("expire-days cannot be negative and expire-rate must be positive")
+    exit(1)
         
 ############################################
 
@@ -205,6 +400,9 @@ if args.name_max_size < 20:
 # This is most likely unix only
 def drop_privileges(uid_name='localpaste'):
     import os, pwd, grp
+    if os.getuid() != 0 and os.getuid() == pwd.getpwnam(uid_name).pw_uid:
+        # a server re-exec'd by one that dropped its privileges already runs as the user
+        return
     if os.getuid() != 0:
         # We're not root so, like, whatever dude
         logerror("You cannot drop privileges if you are not root")
@@ -242,299 +440,3509 @@ class UnsupportedContentTypeException(Exception):
         super(Exception, self).__init__(message)
         self.message = message
 
-def read_data(file, length, content_type):
-    # TODO: if possible, turn it into a stream into the file instead of a big string all in memory at once (a filter rather than slurping)
+class MalformedUploadException(Exception):
+    def __init__(self, message):
+        super(Exception, self).__init__(message)
+        self.message = message
+
+# how much of the request body is read and parsed at a time
+upload_chunk_size = 64*1024
+
+# longest header line or form field name accepted while parsing an upload, so a body without line breaks can't grow the buffer forever
+upload_max_line_size = 8*1024
+
+# An upload being written to a temp file in the datadir, so it can be renamed into place atomically once it is complete.
+# The temp names start with a dot, which the GET path regex never matches, so a partial upload is never served.
+class UploadFile:
+    prefix = ".upload-"
     
-    read_total = 0
-    ending = None
-    oldline = None
-    ignore_next = False
-    logdebug("reading data...")
+    def __init__(self):
+        self.path = None
+        self.file = None
+        self.writer = None
+        self.size = 0
+        # the suffix of the stored file tells which codec it was compressed with
+        self.suffix = compress_suffixes[args.compress]
+        # for dedup, the content is hashed while it streams in, so it never has to be read back
+        self.hash = None
+        if args.dedup:
+            self.hash = hashlib.sha256()
+        # With --storage sqlite, an upload stays in memory until it is too big for the database, so a small paste never
+        # touches the filesystem. After close(), data is the compressed paste if it is still small, or else None.
+        self.buffer = None
+        self.data = None
+        if small_store is not None:
+            self.buffer = bytearray()
+        else:
+            self.open_file()
     
-    if "multipart/form-data" in content_type:
-        # first look for the marker and Content-Disposition
-        # skip the useless \r\n
-        while True:
-            line = file.readline()
-            read_total += len(line)
-            logdebug("read a line: \"%s\"" % (shorten_str(line)))
+    def open_file(self):
+        fd, self.path = tempfile.mkstemp(prefix=UploadFile.prefix, dir=args.datadir)
+        self.file = os.fdopen(fd, "wb")
+        self.writer = make_compressor(args.compress, self.file)
         
-            if not line:
-                break
-            
-            try:
-                line_str = line.decode(data_encoding).splitlines()[0]
-            except:
-                logwarn("failed to decode %s for str = %s... falling back to latin1" % (data_encoding, shorten_str(line)))
-                line_str = line.decode("latin1").splitlines()[0]
-            
-            if "Content-Disposition:" in line_str:
-                ending = oldline
-                logdebug("found Content-Disposition; ending = \"%s\"" % ending)
-                # next line is just "\r\n"... totally useless, so just remove it, since it's not real data
-                line = file.readline()
-                read_total += len(line)
-                break
+    def write(self, data):
+        if self.buffer is not None:
+            if self.size + len(data) <= args.storage_small_size:
+                self.buffer += data
             else:
-                oldline = line_str
-                
-        # then read data until the end, including the end marker and the useless \r\n at the end
-        logdebug("read()")
-        data = file.read(length - read_total)
+                self.open_file()
+                self.writer.write(self.buffer)
+                self.buffer = None
+        if self.buffer is None:
+            self.writer.write(data)
+        self.size += len(data)
+        if self.hash is not None:
+            self.hash.update(data)
         
-        end_str = data[len(data)-len(ending)-4:].decode(data_encoding).splitlines()[0]
+    def close(self):
+        if self.buffer is not None:
+            self.data = compress(args.compress, bytes(self.buffer))
+            self.buffer = None
+        if self.file is None:
+            return
+        if self.writer is not self.file:
+            self.writer.close()
+        self.file.close()
+    
+    # throw away the upload, eg. after an error
+    def discard(self):
+        self.buffer = None
+        self.data = None
+        if self.path is None:
+            return
+        try:
+            self.close()
+        except (OSError, ValueError):
+            pass
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
 
-        if ending and ending in end_str:
-            logdebug("end found")
-            
-        # remove the ending, plus the \r\n that is part of it, plus the \r\n on the next line, and the last \r\n inside the data
-        data = data[0 : len(data)-len(ending)-6]
-    elif content_type == "application/x-www-form-urlencoded":
-        data = file.read(length)
-        data_str = data.decode(data_encoding)
-        data = parse_qs(data_str)["data"][0].encode(data_encoding)
-    else:
-        raise UnsupportedContentTypeException("Unsupported Content-Type: \"%s\"" % content_type)
+############################################
+# Compression
+############################################
 
-    logdebug("done reading data...")
+# file name suffix for each --compress codec; names never contain dots, so the suffix can't be mistaken for part of a name
+compress_suffixes = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# the Content-Encoding of the data in a file with each suffix
+suffix_encodings = {"": None, ".gz": "gzip", ".zst": "zstd"}
+
+# suffixes in the order they are looked for; the current codec comes first, but pastes saved with another --compress setting are still found
+paste_suffixes = [compress_suffixes[args.compress]] + [suffix for suffix in suffix_encodings if suffix != compress_suffixes[args.compress]]
+
+# the zstandard module is only needed for --compress zstd, or to decompress pastes saved that way for clients that don't accept zstd
+def get_zstandard():
+    global zstandard
+    import zstandard
+    return zstandard
 
+# wrap file in a writer that compresses with the codec; the writer's close() doesn't close file
+def make_compressor(codec, file):
+    if codec == "gzip":
+        return gzip.GzipFile(filename="", mode="wb", fileobj=file, mtime=0)
+    elif codec == "zstd":
+        return get_zstandard().ZstdCompressor().stream_writer(file, closefd=False)
+    return file
+
+# wrap file in a reader that decompresses data with the Content-Encoding
+def make_decompressor(encoding, file):
+    if encoding == "gzip":
+        return gzip.GzipFile(mode="rb", fileobj=file)
+    return get_zstandard().ZstdDecompressor().stream_reader(file)
+
+def compress(codec, data):
+    if codec == "gzip":
+        return gzip.compress(data, mtime=0)
+    elif codec == "zstd":
+        return get_zstandard().ZstdCompressor().compress(data)
     return data
 
-def read_file(filename):
-    data = b""
-    with open(os.path.join(args.datadir, filename), 'rb') as f:
+def decompress(encoding, data):
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    return get_zstandard().ZstdDecompressor().decompressobj().decompress(data)
+
+# The uncompressed size of a gzip file with a total size of size, from the 4 byte size at its end, or None if unknown.
+# pread_last(n) returns the last n bytes of the file.
+def uncompressed_size(encoding, size, pread_last):
+    # the gzip size is only stored modulo 2**32
+    if encoding != "gzip" or args.data_max_size >= 2**32 or size < 18:
+        return None
+    return struct.unpack("<I", pread_last(4))[0]
+
+# whether an Accept-Encoding header allows the encoding
+def accepts_encoding(accept_encoding, encoding):
+    if not accept_encoding:
+        return False
+    for item in accept_encoding.split(","):
+        coding, sep, params = item.partition(";")
+        if coding.strip().lower() not in (encoding, "*"):
+            continue
+        q = get_header_param(";" + params, "q")
+        try:
+            return q is None or float(q) > 0
+        except ValueError:
+            return False
+    return False
+
+# Incremental multipart/form-data parser. The body can be fed in pieces of any size, and part data is written
+# out as it arrives, so at most one chunk plus the length of the boundary is ever held in memory.
+# on_part is called with the headers of each part and returns a writer for its data, or None to skip the part.
+class MultipartParser:
+    def __init__(self, boundary, on_part):
+        self.delimiter = b"\r\n--" + boundary
+        self.on_part = on_part
+        # the first delimiter starts the body, without the \r\n in front of it
+        self.buffer = b"\r\n"
+        self.state = "preamble"
+        self.headers = None
+        self.out = None
+        
+    def feed(self, data):
+        self.buffer += data
         while True:
-            chunk = f.read()
-            if chunk:
-                data += chunk
+            if self.state == "preamble":
+                i = self.buffer.find(self.delimiter)
+                if i < 0:
+                    self.buffer = self.buffer[-(len(self.delimiter)-1):]
+                    return
+                self.buffer = self.buffer[i+len(self.delimiter):]
+                self.state = "delimiter"
+            elif self.state == "delimiter":
+                # after a delimiter is either "--" for the end of the body, or the rest of the line before the part headers
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer.startswith(b"--"):
+                    self.buffer = b""
+                    self.state = "epilogue"
+                    return
+                i = self.buffer.find(b"\r\n")
+                if i < 0:
+                    self.check_line_size()
+                    return
+                self.buffer = self.buffer[i+2:]
+                self.headers = {}
+                self.state = "headers"
+            elif self.state == "headers":
+                i = self.buffer.find(b"\r\n")
+                if i < 0:
+                    self.check_line_size()
+                    return
+                line = self.buffer[0:i].decode("latin1")
+                self.buffer = self.buffer[i+2:]
+                if line:
+                    key, sep, value = line.partition(":")
+                    self.headers[key.strip().lower()] = value.strip()
+                    logdebug("part header: \"%s\"" % shorten_str(line))
+                else:
+                    self.out = self.on_part(self.headers)
+                    self.state = "data"
+            elif self.state == "data":
+                i = self.buffer.find(self.delimiter)
+                if i < 0:
+                    # keep enough of the end to find a delimiter split between two chunks
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        self.write(self.buffer[0:len(self.buffer)-keep])
+                        self.buffer = self.buffer[len(self.buffer)-keep:]
+                    return
+                self.write(self.buffer[0:i])
+                self.buffer = self.buffer[i+len(self.delimiter):]
+                self.out = None
+                self.state = "delimiter"
             else:
-                break
-    return data
+                # epilogue; ignored
+                self.buffer = b""
+                return
+    
+    def write(self, data):
+        if self.out is not None and data:
+            self.out.write(data)
+    
+    def check_line_size(self):
+        if len(self.buffer) > upload_max_line_size:
+            raise MalformedUploadException("multipart header line too long")
+    
+    def close(self):
+        if self.state != "epilogue":
+            raise MalformedUploadException("multipart data ended before the closing boundary")
 
-# generate a short unique name
-def generate_name():
-    # start with high precision timestamp
-    timestamp_str = str(time.time())
-    #timestamp_str = "test value"
-    ts_bytes = str.encode(timestamp_str)
-    
-    h = hashlib.sha1()
-    h.update(ts_bytes)
-    for l in range(args.name_min_size, args.name_max_size):
-        # try larger and larger sizes to get smallest unique value
-        for n in range(1, 100):
-            # then hash it with sha1 (bytes, not hex str)
-            # here we add n to the end, so first it was time1, then time12, then time123, ... time123...9899100 being hashed
-            h.update(str.encode("%s" % n))
-            hashbytes = h.digest()
-            
-            # then base64 it
-            base64bytes = base64.b64encode(hashbytes)
-            base64str = base64bytes.decode(data_encoding)
-            
-            # then remove slashes and dots
-            base64str = base64str.replace("/", "")
-            base64str = base64str.replace(".", "")
-            
-            # then shrink it to the target size
-            check = base64str[0:l]
-            if not os.path.isfile(os.path.join(args.datadir, check)):
-                return check
-        
-    return None
+# Incremental application/x-www-form-urlencoded parser, which writes the decoded value of one field as it arrives.
+class UrlencodedParser:
+    def __init__(self, field, out):
+        self.field = field
+        self.out = out
+        self.buffer = b""
+        self.in_value = False
+        self.writing = False
+        self.found = False
+    
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if not self.in_value:
+                i = self.buffer.find(b"=")
+                j = self.buffer.find(b"&")
+                if 0 <= j and (j < i or i < 0):
+                    # a name without a value
+                    self.buffer = self.buffer[j+1:]
+                    continue
+                if i < 0:
+                    if len(self.buffer) > upload_max_line_size:
+                        raise MalformedUploadException("form field name too long")
+                    return
+                name = unquote_plus(self.buffer[0:i].decode("latin1"))
+                self.buffer = self.buffer[i+1:]
+                self.in_value = True
+                # if the field is repeated, only the first value is used
+                self.writing = name == self.field and not self.found
+                if self.writing:
+                    self.found = True
+            else:
+                j = self.buffer.find(b"&")
+                if j < 0:
+                    # hold back a %XX escape that might be split between two chunks
+                    k = self.buffer.rfind(b"%", max(0, len(self.buffer)-2))
+                    end = k if k >= 0 else len(self.buffer)
+                    self.write(self.buffer[0:end])
+                    self.buffer = self.buffer[end:]
+                    return
+                self.write(self.buffer[0:j])
+                self.buffer = self.buffer[j+1:]
+                self.in_value = False
+    
+    def write(self, data):
+        if self.writing and data:
+            self.out.write(unquote_to_bytes(data.replace(b"+", b" ")))
+    
+    def close(self):
+        if self.in_value:
+            self.write(self.buffer)
+        self.buffer = b""
 
-def save_file(name, data):
-    path=os.path.join(args.datadir, name)
+tar_block_size = 512
+
+# Incremental tar parser, which writes the contents of each regular file in the archive to the file returned by on_part(name).
+# Other members, like directories and the extra headers of pax and GNU tar, are skipped.
+class TarParser:
+    def __init__(self, on_part):
+        self.on_part = on_part
+        self.buffer = b""
+        self.state = "header"
+        self.out = None
+        # bytes of member data, and then of padding up to the next block, still to come
+        self.remaining = 0
+        self.padding = 0
+    
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.state == "header":
+                if len(self.buffer) < tar_block_size:
+                    return
+                block = self.buffer[0:tar_block_size]
+                self.buffer = self.buffer[tar_block_size:]
+                if block == bytes(tar_block_size):
+                    # the end of the archive
+                    self.state = "end"
+                    continue
+                self.start_member(block)
+                self.state = "data"
+            elif self.state == "data":
+                n = min(len(self.buffer), self.remaining)
+                if self.out is not None and n:
+                    self.out.write(self.buffer[0:n])
+                self.remaining -= n
+                n2 = min(len(self.buffer) - n, self.padding)
+                self.padding -= n2
+                self.buffer = self.buffer[n+n2:]
+                if self.remaining or self.padding:
+                    return
+                self.out = None
+                self.state = "header"
+            else:
+                # the second zero block and the padding to the end of the last tar record; ignored
+                self.buffer = b""
+                return
     
-    if os.path.isfile(path):
-        logerror("the file \"%s\" already exists... failed to save paste" % path)
+    def start_member(self, block):
+        # the checksum is the sum of the header bytes, with the checksum field itself counted as spaces
+        try:
+            checksum = int(block[148:156].split(b"\0")[0].strip() or b"0", 8)
+            size_field = block[124:136]
+            if size_field[0] & 0x80:
+                # base-256, for sizes that don't fit in octal
+                size = int.from_bytes(size_field[1:], "big")
+            else:
+                size = int(size_field.split(b"\0")[0].strip() or b"0", 8)
+        except ValueError:
+            raise MalformedUploadException("invalid tar header")
+        if checksum != sum(block[0:148]) + 8*ord(" ") + sum(block[156:]):
+            raise MalformedUploadException("invalid tar header checksum")
         
-    # save the file
-    with open(path, 'wb') as f:
-        f.write(bytes(data))
+        name = block[0:100].split(b"\0")[0].decode("utf-8", "replace")
+        typeflag = block[156:157]
+        logdebug("tar member: \"%s\", type %s, size %s" % (shorten_str(name), typeflag, size))
+        self.out = None
+        # regular files; 7 is a contiguous file, which is a regular file to everything but a few old unixes
+        if typeflag in (b"0", b"\0", b"7"):
+            self.out = self.on_part(name)
+        self.remaining = size
+        self.padding = -size % tar_block_size
+    
+    def close(self):
+        if self.state == "data" or self.buffer:
+            raise MalformedUploadException("tar data ended in the middle of a file")
 
-class LocalPasteHandler(http.server.BaseHTTPRequestHandler):
-    def __init__(self, request, client_address, server):
-        logdebug("LocalPasteHandler.init() called")
-        super(LocalPasteHandler, self).__init__(request, client_address, server)
-        
-    # For handling input
-    def do_POST(self):
-        client_supplied_hostname_and_port = None
-        if "Host" in self.headers:
-            client_supplied_hostname_and_port = self.headers["Host"]
-        
-        logdebug("LocalPasteHandler.handle() called")
-        log("client %s - connected" % str(self.client_address))
-        logdebug("client %s - calling read_report" % str(self.client_address))
+# get a parameter like boundary=xyz out of a header like Content-Type
+def get_header_param(value, name):
+    for param in value.split(";")[1:]:
+        key, sep, v = param.strip().partition("=")
+        if key.lower() == name:
+            return v.strip('"')
+    return None
+
+# A parser for an upload with this Content-Type, which writes each paste in it to a file returned by new_upload().
+# A multipart upload is one paste, from its first part, unless multi is set, when every part is a paste.
+# Every regular file in a tar upload is a paste.
+def make_upload_parser(content_type, new_upload, multi):
+    if content_type and "multipart/form-data" in content_type:
+        boundary = get_header_param(content_type, "boundary")
+        if not boundary:
+            raise MalformedUploadException("multipart Content-Type without a boundary")
+        logdebug("boundary = \"%s\"" % boundary)
         
-        content_length = int(self.headers["Content-Length"])
-        if content_length > args.data_max_size:
-            self.send_response(400)
-            self.end_headers()
-            message = "Maximum content-length is %s, but recieved %s" % (args.data_max_size, content_length)
-            self.wfile.write(message.encode(data_encoding))
+        # without multi, only the first part is stored; the rest are read and ignored
+        parts = []
+        def on_part(headers):
+            parts.append(headers)
+            if multi or len(parts) == 1:
+                return new_upload()
+            return None
+        return MultipartParser(boundary.encode("latin1"), on_part)
+    elif content_type == "application/x-www-form-urlencoded":
+        return UrlencodedParser("data", new_upload())
+    elif content_type == "application/x-tar":
+        return TarParser(lambda name: new_upload())
+    else:
+        raise UnsupportedContentTypeException("Unsupported Content-Type: \"%s\"" % content_type)
+
+# Read length bytes of request body from file, and feed them to parser.
+def read_data(file, length, parser):
+    logdebug("reading data...")
+    
+    remaining = length
+    while remaining > 0:
+        chunk = file.read(min(upload_chunk_size, remaining))
+        if not chunk:
+            raise MalformedUploadException("request body ended %s bytes before Content-Length" % remaining)
+        remaining -= len(chunk)
+        parser.feed(chunk)
+    parser.close()
+    
+    logdebug("done reading data...")
+
+# an upload temp file that wasn't written to for this many seconds is not in progress in any process
+stale_upload_age = 3600
+
+# Remove temp files left behind by uploads that were interrupted by a crash or kill. With the flat layout this reads
+# the whole datadir, so it runs in the background, and leaves alone the files of uploads that might still be going on.
+def remove_stale_uploads():
+    count = 0
+    for entry in os.scandir(args.datadir):
+        if entry.name.startswith(UploadFile.prefix):
+            try:
+                if entry.stat().st_mtime > time.time() - stale_upload_age:
+                    continue
+                logdebug("removing stale upload %s" % entry.path)
+                os.unlink(entry.path)
+                count += 1
+            except FileNotFoundError:
+                pass
+    if count:
+        log("removed %s stale uploads" % count)
+
+############################################
+# Storage layout
+############################################
+
+# prefix for files being moved by migrate_layout
+migrate_prefix = ".migrating-"
+
+shard_dir_regex = re.compile("^[0-9a-f][0-9a-f]$")
+
+# where a paste is stored in the datadir
+def paste_path(name, layout=None):
+    if (layout or args.layout) == "sharded":
+        # a hash spreads the names evenly, even though they are random already, since names with a given prefix might be more common
+        h = hashlib.sha1(name.encode("latin1")).hexdigest()
+        return os.path.join(args.datadir, h[0:2], h[2:4], name)
+    return os.path.join(args.datadir, name)
+
+# the name of the paste stored in a file, without the compression suffix
+def file_paste_name(filename):
+    return filename.partition(".")[0]
+
+# yield (name, path) for every paste, where path is None for the ones in the database of --storage sqlite
+def iter_all_pastes():
+    yield from iter_pastes()
+    if small_store is not None:
+        for name in small_store.names():
+            yield name, None
+
+# yield (name, path) for every paste file stored in the given layout
+def iter_pastes(layout=None):
+    if (layout or args.layout) == "flat":
+        for entry in os.scandir(args.datadir):
+            # dot files are uploads in progress, and directories are shards
+            if not entry.name.startswith(".") and entry.is_file():
+                yield file_paste_name(entry.name), entry.path
+        return
+    
+    for level1 in os.scandir(args.datadir):
+        if not shard_dir_regex.match(level1.name) or not level1.is_dir():
+            continue
+        for level2 in os.scandir(level1.path):
+            if not shard_dir_regex.match(level2.name) or not level2.is_dir():
+                continue
+            for entry in os.scandir(level2.path):
+                if not entry.name.startswith("."):
+                    yield file_paste_name(entry.name), entry.path
+
+# With the sharded layout, pastes directly in the datadir were left by the flat layout and would never be found.
+def check_layout():
+    if args.layout != "sharded":
+        return
+    for entry in os.scandir(args.datadir):
+        if not entry.name.startswith(".") and entry.is_file():
+            logwarn("found pastes stored in the flat layout in %s; use --migrate-layout to move them into the sharded layout" % args.datadir)
             return
-        
-        content_type = self.headers["Content-Type"]
+
+# move every paste into the layout given by --layout
+def migrate_layout():
+    if args.layout == "flat":
+        old_layout = "sharded"
+    else:
+        old_layout = "flat"
+    log("moving pastes from the %s layout to the %s layout in %s" % (old_layout, args.layout, args.datadir))
+    
+    # Files are renamed out of the way first, because in the datadir itself, a flat paste can have the same
+    # name as a shard directory. A migration that was interrupted leaves these behind, and they are picked up again here.
+    count = 0
+    staged = []
+    for name, path in list(iter_pastes(old_layout)):
+        os.rename(path, os.path.join(args.datadir, migrate_prefix + os.path.basename(path)))
+    for entry in os.scandir(args.datadir):
+        if entry.name.startswith(migrate_prefix):
+            staged.append((entry.name[len(migrate_prefix):], entry.path))
+    
+    for filename, staged_path in staged:
+        # keep the compression suffix
+        path = os.path.join(os.path.dirname(paste_path(file_paste_name(filename))), filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.rename(staged_path, path)
+        count += 1
+        if count % 10000 == 0:
+            log("moved %s pastes" % count)
+    
+    if old_layout == "sharded":
+        # remove the now empty shard directories
+        for level1 in os.scandir(args.datadir):
+            if shard_dir_regex.match(level1.name) and level1.is_dir():
+                for level2 in os.scandir(level1.path):
+                    if shard_dir_regex.match(level2.name) and level2.is_dir():
+                        os.rmdir(level2.path)
+                os.rmdir(level1.path)
+    
+    log("moved %s pastes" % count)
+
+# yield (path, encoding) for each file a paste could be stored in
+def paste_files(name):
+    path = paste_path(name)
+    for suffix in paste_suffixes:
+        yield path + suffix, suffix_encodings[suffix]
+
+# open a paste; returns (file, encoding)
+def open_paste(name):
+    for path, encoding in paste_files(name):
         try:
-            data = read_data(self.rfile, content_length, content_type)
-        except UnsupportedContentTypeException as e:
-            # no printing to log here; already done in read_data
-            self.send_response(500)
-            self.end_headers()
-            print(dir(e))
-            message = e.message
-            self.wfile.write(message.encode(data_encoding))
-            
-        logdebug("input was %s long" % len(data))
+            return open(path, 'rb'), encoding
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(paste_path(name))
 
-        if( len(data) == 0 ):
-            self.send_response(400)
-            self.end_headers()
-            message = "empty data"
-            self.wfile.write(message.encode(data_encoding))
+# an os.stat() of the paste file, or a SqliteStat
+def stat_paste(name):
+    if small_store is not None:
+        st = small_store.stat(name)
+        if st is not None:
+            return st
+    for path, encoding in paste_files(name):
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(paste_path(name))
+
+############################################
+# SQLite storage
+############################################
+
+# Pastes in the database have no file to stat, so stat_paste gives this, with the fields of os.stat() that the rest of the server uses.
+class SqliteStat:
+    def __init__(self, rowid, size, created):
+        # negative, so it can't be the inode of a paste file that had the same name before
+        self.st_ino = -rowid
+        self.st_size = size
+        self.st_mtime = created
+        self.st_mtime_ns = int(created * 1e9)
+        self.st_nlink = 1
+
+# Small pastes in one SQLite database, for --storage sqlite: saving or reading one is a b-tree lookup in a file that
+# is already open, instead of creating or opening a file per paste, and a backup is one file. Names are unique in the
+# table, so an INSERT claims a name the way os.link() does for paste files. In WAL mode, readers don't wait for
+# writers, and several processes can share the database.
+class SqliteStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+    
+    # a connection for this thread; sqlite connections can't be shared between threads, or used again after a fork
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+    
+    def create(self):
+        db = self.connection()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS pastes (name TEXT PRIMARY KEY, created REAL NOT NULL, encoding TEXT, data BLOB NOT NULL)")
+        if args.user and os.getuid() == 0:
+            # the server writes to it after dropping privileges
+            import pwd
+            target_user = pwd.getpwnam(args.user)
+            os.chown(self.path, target_user.pw_uid, target_user.pw_gid)
+    
+    # close the connection of this thread, eg. before dropping privileges, since the -wal and -shm files it has open belong to root
+    def close(self):
+        db = getattr(self.local, "db", None)
+        if db is not None and self.local.pid == os.getpid():
+            db.close()
+        self.local.db = None
+    
+    def names(self):
+        for (name,) in self.connection().execute("SELECT name FROM pastes"):
+            yield name
+    
+    # returns (data, encoding, SqliteStat), or None
+    def get(self, name):
+        row = self.connection().execute("SELECT rowid, created, encoding, data FROM pastes WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        rowid, created, encoding, data = row
+        return data, encoding, SqliteStat(rowid, len(data), created)
+    
+    def stat(self, name):
+        row = self.connection().execute("SELECT rowid, length(data), created FROM pastes WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return SqliteStat(*row)
+    
+    # returns False if the name is taken
+    def put(self, name, data, encoding):
+        try:
+            self.connection().execute("INSERT INTO pastes (name, created, encoding, data) VALUES (?, ?, ?, ?)", (name, time.time(), encoding, data))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+    
+    # returns False if there was no such paste
+    def delete(self, name):
+        return self.connection().execute("DELETE FROM pastes WHERE name = ?", (name,)).rowcount > 0
+
+small_store = None
+if args.storage == "sqlite":
+    small_store = SqliteStore(os.path.join(args.datadir, ".pastes.sqlite"))
+
+# An LRU cache of paste contents limited to a total number of bytes, so popular pastes are served from memory.
+# Pastes never change once saved, so entries only leave by eviction or discard().
+class PasteCache:
+    def __init__(self, max_bytes, max_object_size):
+        self.max_bytes = max_bytes
+        self.max_object_size = min(max_object_size, max_bytes)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    # whether a paste of this size would be cached
+    def accepts(self, size):
+        return 0 < size <= self.max_object_size
+    
+    # returns (data, encoding, validators) as stored on disk, or None
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[3] is not None and entry[3] <= time.time():
+                # another process might have deleted the file already, so it is a miss even before this process's expiry thread gets to it
+                self.entries.pop(name)
+                self.size -= len(entry[0])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return entry[0:3]
+    
+    # expires_at is when the paste expires, or None if it doesn't
+    def put(self, name, data, encoding, validators, expires_at=None):
+        if not self.accepts(len(data)):
+            return
+        with self.lock:
+            if name in self.entries:
+                return
+            self.entries[name] = (data, encoding, validators, expires_at)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                old_name, old_entry = self.entries.popitem(last=False)
+                self.size -= len(old_entry[0])
+                self.evictions += 1
+    
+    def discard(self, name):
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                self.size -= len(entry[0])
+    
+    def stats_str(self):
+        with self.lock:
+            return "cache: %s hits, %s misses, %s evictions, %s pastes, %s bytes" % (self.hits, self.misses, self.evictions, len(self.entries), self.size)
+
+paste_cache = PasteCache(args.cache_bytes, args.cache_max_object_size)
+
+# rendered pages of the html view, keyed by their ETag, which has the paste, the page and the renderer version
+render_cache = PasteCache(args.render_cache_bytes, args.render_cache_bytes)
+
+# how much of a memory-mapped paste is handed to the TLS socket per write
+mmap_write_size = 1024*1024
+
+# Send count bytes of the open file f, starting at offset, to the client of handler.
+def write_file_to_client(handler, f, offset, count):
+    if args.scheme == "http":
+        # sendfile copies from the page cache straight into the socket, without the data passing through python
+        handler.connection.sendfile(f, offset, count)
+        return
+    
+    # TLS encrypts in userspace, so sendfile can't be used; write slices of a memory map of the file instead, which are not copied
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        view = memoryview(m)
+        try:
+            end = offset + count
+            while offset < end:
+                offset += handler.wfile.write(view[offset:min(end, offset+mmap_write_size)])
+        finally:
+            view.release()
+
+############################################
+# Paste index
+############################################
+
+# The name, size, mtime, expiry and inode of every paste, so the server can start without reading the whole datadir.
+# The snapshot file is a header and then fixed size records sorted by name, and a name is looked up with a binary search
+# in a memory map of it, so loading it takes the same time however many pastes there are. Every process appends the
+# pastes it saves and deletes to a journal, which is replayed on top of the snapshot at startup. Process 0 merges the
+# journal into a new snapshot from time to time, and the header says how much of the journal the snapshot covers.
+# Replaying an entry that the snapshot already has changes nothing, so a crash between the steps loses nothing.
+index_magic = b"LPIX"
+index_version = 1
+
+# magic, version, name width, record count, journal bytes covered by the snapshot
+index_header = struct.Struct("<4sIIQQ")
+
+# how many journal bytes the snapshot doesn't cover yet before process 0 merges them in, and how often it checks
+index_compact_bytes = 16*1024*1024
+index_compact_interval = 600
+
+# the fields of a record after the name, padded with NULs to the name width: size, mtime, expires_at (0 without a ttl), inode
+def index_record_struct(width):
+    return struct.Struct("<%dsQddq" % width)
+
+# journal lines are "+ NAME SIZE MTIME EXPIRES_AT INODE" and "- NAME"; an unfinished last line is left for later
+def parse_index_journal(data, changes):
+    for line in data.decode("utf-8", "surrogateescape").splitlines():
+        if line.startswith("- "):
+            changes[line[2:]] = None
+        elif line.startswith("+ "):
+            fields = line[2:].rsplit(" ", 4)
+            try:
+                changes[fields[0]] = (int(fields[1]), float(fields[2]), float(fields[3]), int(fields[4]))
+            except (IndexError, ValueError):
+                logwarn("ignoring a broken line in the paste index journal: %s" % line)
+
+# files written at startup as root are appended to by the server after it drops privileges
+def chown_to_user(path):
+    if args.user and os.getuid() == 0:
+        import pwd
+        target_user = pwd.getpwnam(args.user)
+        os.chown(path, target_user.pw_uid, target_user.pw_gid)
+
+class PasteIndex:
+    def __init__(self):
+        self.path = os.path.join(args.datadir, ".index")
+        self.journal_path = self.path + ".journal"
+        self.map = None
+        self.record = None
+        self.width = 0
+        self.count = 0
+        self.journal_offset = 0
+        # name -> (size, mtime, expires_at, inode), or None for a deleted paste: the journal entries replayed at startup,
+        # and the changes made by this process since, which the snapshot it has mapped doesn't have
+        self.changes = {}
+        self.length = 0
+        self.journal = None
+        self.lock = threading.Lock()
+        # the inode of the journal and how much of it is in self.changes, for refresh()
+        self.journal_inode = None
+        self.journal_read = 0
+        self.refresh_lock = threading.Lock()
+        # called by refresh() with the changes it read, in the process that expires pastes
+        self.on_refresh = None
+    
+    # map the snapshot file; returns False if there is none that this version can read
+    def open_snapshot(self):
+        try:
+            with open(self.path, "rb") as f:
+                header = f.read(index_header.size)
+                if len(header) < index_header.size:
+                    return False
+                magic, version, width, count, journal_offset = index_header.unpack(header)
+                record = index_record_struct(width)
+                if magic != index_magic or version != index_version or os.fstat(f.fileno()).st_size != index_header.size + count*record.size:
+                    logwarn("%s is not a paste index this version can read" % self.path)
+                    return False
+                m = None
+                if count > 0:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            # the old map is left to the garbage collector, since other threads might still be reading it
+            self.map = m
+            self.record = record
+            self.width = width
+            self.count = count
+            self.journal_offset = journal_offset
+        return True
+    
+    def load(self):
+        start = time.time()
+        if args.rebuild_index or not self.open_snapshot():
+            self.rebuild()
+        replayed = self.replay()
+        self.length = self.count
+        for name, value in self.changes.items():
+            self.length += (value is not None) - (self.find(name) is not None)
+        if self.journal_offset > 0 and old_server_pid is None:
+            self.shrink_journal()
+        log("loaded the index of %s pastes in %s, with %s changes from the journal (%.3fs)" % (
+            self.length, args.datadir, replayed, time.time() - start))
+    
+    # write a new snapshot from the files in the datadir, and start a new journal
+    def rebuild(self):
+        start = time.time()
+        log("reading the datadir %s to build its index" % args.datadir)
+        records = {}
+        for name, path in iter_all_pastes():
+            try:
+                if path is None:
+                    st = stat_paste(name)
+                else:
+                    st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # the ttl of a paste is in the expiry journal, which ExpiryQueue.load_existing still reads
+            records[name] = (st.st_size, st.st_mtime, 0, st.st_ino)
+        width = max([len(name.encode("utf-8", "surrogateescape")) for name in records] or [1])
+        self.write_snapshot(sorted(records.items()), width, 0)
+        try:
+            os.unlink(self.journal_path)
+        except FileNotFoundError:
+            pass
+        self.open_snapshot()
+        log("indexed %s pastes (%.3fs)" % (len(records), time.time() - start))
+    
+    # write records, sorted (name, value) pairs, to a new snapshot file that replaces the old one
+    def write_snapshot(self, records, width, journal_offset):
+        record = index_record_struct(width)
+        # a process taking over from this one might be compacting too
+        tmp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        count = 0
+        with open(tmp_path, "wb") as f:
+            f.write(index_header.pack(index_magic, index_version, width, 0, journal_offset))
+            for name, (size, mtime, expires_at, inode) in records:
+                f.write(record.pack(name.encode("utf-8", "surrogateescape"), size, mtime, expires_at, inode))
+                count += 1
+            f.seek(0)
+            f.write(index_header.pack(index_magic, index_version, width, count, journal_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        chown_to_user(tmp_path)
+        os.rename(tmp_path, self.path)
+    
+    # read the journal entries the snapshot doesn't cover into self.changes; returns how many there were
+    def replay(self):
+        try:
+            with open(self.journal_path, "rb") as f:
+                self.journal_inode = os.fstat(f.fileno()).st_ino
+                f.seek(self.journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        end = data.rfind(b"\n") + 1
+        changes = {}
+        parse_index_journal(data[:end], changes)
+        self.journal_read = self.journal_offset + end
+        with self.lock:
+            self.changes.update(changes)
+        return len(changes)
+    
+    # Read the entries that the other processes appended to the journal since this one last read it, so the pastes they
+    # saved are known here too. Replaying an entry again changes nothing, so the journal being replaced by a new server
+    # only means it is read from the start.
+    def refresh(self):
+        with self.refresh_lock:
+            try:
+                with open(self.journal_path, "rb") as f:
+                    inode = os.fstat(f.fileno()).st_ino
+                    if inode != self.journal_inode:
+                        self.journal_inode = inode
+                        self.journal_read = 0
+                    f.seek(self.journal_read)
+                    data = f.read()
+            except FileNotFoundError:
+                return
+            end = data.rfind(b"\n") + 1
+            changes = {}
+            parse_index_journal(data[:end], changes)
+            self.journal_read += end
+            with self.lock:
+                for name, value in changes.items():
+                    self.length += (value is not None) - (self.changes.get(name, self.find(name)) is not None)
+                    self.changes[name] = value
+            if self.on_refresh is not None:
+                self.on_refresh(changes)
+    
+    # At startup, before any other process appends to it, drop the part of the journal that the snapshot covers. The header
+    # is changed first: if the journal isn't replaced after all, its entries are just replayed again.
+    def shrink_journal(self):
+        with open(self.journal_path, "rb") as f:
+            f.seek(self.journal_offset)
+            data = f.read()
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, index_header.pack(index_magic, index_version, self.width, self.count, 0), 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            self.journal_inode = os.fstat(f.fileno()).st_ino
+        chown_to_user(tmp_path)
+        os.rename(tmp_path, self.journal_path)
+        self.journal_read -= self.journal_offset
+        self.journal_offset = 0
+    
+    # the (size, mtime, expires_at, inode) of a paste in the snapshot, or None
+    def find(self, name):
+        key = name.encode("utf-8", "surrogateescape")
+        if len(key) > self.width:
+            return None
+        key = key.ljust(self.width, b"\0")
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = index_header.size + mid*self.record.size
+            found = self.map[offset:offset+self.width]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return self.record.unpack_from(self.map, offset)[1:]
+        return None
+    
+    def contains(self, name):
+        with self.lock:
+            if name in self.changes:
+                return self.changes[name] is not None
+            return self.find(name) is not None
+    
+    # the (size, mtime, expires_at, inode) of a paste that exists, or None; one this process doesn't know yet was saved by
+    # another process, so the journal is read again for it
+    def get(self, name):
+        with self.lock:
+            value = self.changes.get(name, self.find(name))
+        if value is None:
+            self.refresh()
+            with self.lock:
+                value = self.changes.get(name, self.find(name))
+        return value
+    
+    # yield (name, (size, mtime, expires_at, inode)) for the pastes in the snapshot, in name order
+    def iter_snapshot(self):
+        with self.lock:
+            m = self.map
+            record = self.record
+            count = self.count
+        if m is None:
             return
+        for fields in record.iter_unpack(memoryview(m)[index_header.size:index_header.size + count*record.size]):
+            yield fields[0].rstrip(b"\0").decode("utf-8", "surrogateescape"), fields[1:]
+    
+    # yield (name, (size, mtime, expires_at, inode)) for every paste
+    def iter_records(self):
+        with self.lock:
+            changes = dict(self.changes)
+        for name, value in self.iter_snapshot():
+            if name not in changes:
+                yield name, value
+        for name, value in changes.items():
+            if value is not None:
+                yield name, value
+    
+    def append(self, line):
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.journal_path, "a")
+            self.journal.write(line)
+            self.journal.flush()
+    
+    # record a paste that was just saved; expires_at is 0 if it has no ttl
+    def add(self, name, st, expires_at):
+        value = (st.st_size, st.st_mtime, expires_at, st.st_ino)
+        self.append("+ %s %s %r %r %s\n" % (name, value[0], value[1], value[2], value[3]))
+        with self.lock:
+            if self.changes.get(name, self.find(name)) is None:
+                self.length += 1
+            self.changes[name] = value
+    
+    def remove(self, name):
+        self.append("- %s\n" % name)
+        with self.lock:
+            if self.changes.get(name, self.find(name)) is not None:
+                self.length -= 1
+            self.changes[name] = None
+    
+    # merge the journal entries of all the processes into a new snapshot
+    def compact(self):
+        start = time.time()
+        with open(self.journal_path, "rb") as f:
+            f.seek(self.journal_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        changes = {}
+        parse_index_journal(data[:end], changes)
+        width = max([self.width] + [len(name.encode("utf-8", "surrogateescape")) for name in changes])
+        self.write_snapshot(self.merge(self.iter_snapshot(), sorted(changes.items())), width, self.journal_offset + end)
+        self.open_snapshot()
+        log("merged %s changes into the paste index (%.3fs)" % (len(changes), time.time() - start))
+    
+    # merge two sorted iterables of (name, value), where the changes win, and a None value deletes the name
+    def merge(self, records, changes):
+        changes = iter(changes)
+        change = next(changes, None)
+        for name, value in records:
+            while change is not None and change[0] < name:
+                if change[1] is not None:
+                    yield change
+                change = next(changes, None)
+            if change is not None and change[0] == name:
+                if change[1] is not None:
+                    yield change
+                change = next(changes, None)
+                continue
+            yield name, value
+        while change is not None:
+            if change[1] is not None:
+                yield change
+            change = next(changes, None)
+    
+    def run(self):
+        while True:
+            try:
+                if os.stat(self.journal_path).st_size - self.journal_offset > index_compact_bytes:
+                    self.compact()
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logerror("failed to merge the paste index journal: %s" % e)
+            time.sleep(index_compact_interval)
+    
+    def start(self):
+        if process_slot == 0:
+            t = threading.Thread(target=self.run, name="index-compact")
+            t.daemon = True
+            t.start()
+    
+    def __len__(self):
+        return self.length
+
+paste_index = PasteIndex()
+
+# Names of the pastes being saved by this process, which are not in paste_index yet, so new names can be checked for
+# collisions in memory instead of with a stat per candidate. Other processes sharing the datadir can still add names
+# behind our back; save_file catches those, and they stay reserved here then.
+class NameIndex:
+    def __init__(self):
+        self.names = set()
+        self.lock = threading.Lock()
+    
+    # claim a name; returns False if it is already in use
+    def reserve(self, name):
+        with self.lock:
+            if name in self.names or paste_index.contains(name):
+                return False
+            self.names.add(name)
+            return True
+    
+    def add(self, name):
+        with self.lock:
+            self.names.add(name)
+    
+    def discard(self, name):
+        with self.lock:
+            self.names.discard(name)
+
+name_index = NameIndex()
+
+# only letters and digits, so names never need escaping and always match the GET path regex
+name_alphabet = string.ascii_letters + string.digits
+
+# how many random names of one length to try before using a longer one
+name_attempts_per_size = 4
+
+# generate a short unique name, and reserve it in name_index
+def generate_name():
+    for l in range(args.name_min_size, args.name_max_size + 1):
+        # try larger and larger sizes to get smallest unique value
+        for n in range(name_attempts_per_size):
+            # the names come from a CSPRNG, so concurrent requests can't end up with the same sequence of candidates
+            check = "".join(secrets.choice(name_alphabet) for i in range(l))
+            if name_index.reserve(check):
+                return check
         
-        # pick a name
+    return None
+
+# time generate_name against the names in the datadir; the names stay reserved in memory only
+def bench_generate_name(count):
+    start = time.perf_counter()
+    if small_store is not None:
+        small_store.create()
+    paste_index.load()
+    load_time = time.perf_counter() - start
+    existing = len(paste_index)
+    
+    times = []
+    lengths = 0
+    for n in range(count):
+        start = time.perf_counter()
         name = generate_name()
-        logdebug("name = %s" % name)
-        
-        logdebug("client %s - calling save_file" % str(self.client_address))
-        save_file(name, data)
-        log("client %s - completed" % str(self.client_address))
-        
-        # Tell the client the name
-        self.send_response(200)
-        self.end_headers()
-        
-        # prepend a url
-        if not hostname_and_port is None:
-            use_hostname_and_port = hostname_and_port
+        times.append(time.perf_counter() - start)
+        if name is None:
+            logerror("generate_name failed after %s names" % n)
+            break
+        lengths += len(name)
+    times.sort()
+    
+    print("names=%s load_seconds=%.3f calls=%s mean_us=%.2f p50_us=%.2f p99_us=%.2f max_us=%.2f mean_length=%.2f" % (
+        existing, load_time, len(times),
+        sum(times) / len(times) * 1e6, times[len(times)//2] * 1e6, times[int(len(times)*0.99)] * 1e6, times[-1] * 1e6,
+        lengths / len(times)))
+
+# Move a completed upload into place under its name.
+# Returns False if a paste with that name already exists, as a file or in the database, in which case the upload is left alone.
+def save_file(name, upload):
+    if upload.data is not None:
+        if not small_store.put(name, upload.data, suffix_encodings[upload.suffix]):
+            return False
+        # The database and the datadir don't know about each other's names, so another process might have saved a file
+        # paste with this name at the same time. Each side checks the other after taking the name, so one of them backs off.
+        if any(os.path.lexists(path) for path, encoding in paste_files(name)):
+            small_store.delete(name)
+            return False
+        return True
+    
+    path=paste_path(name) + upload.suffix
+    if args.layout == "sharded":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    
+    # link() fails if the target exists, like an O_EXCL create, so two writers can never overwrite each other,
+    # and since the upload is already complete, readers see either nothing or the whole paste
+    try:
+        if args.dedup:
+            save_deduplicated(name, upload, path)
         else:
-            use_hostname_and_port = client_supplied_hostname_and_port
-        message = "%s://%s/%s\r\n" % (args.scheme, use_hostname_and_port, name)
-        self.wfile.write(message.encode(data_encoding))
+            os.link(upload.path, path)
+    except FileExistsError:
+        return False
+    if small_store is not None and small_store.stat(name) is not None:
+        # the other side of the check above
+        os.unlink(path)
+        if args.dedup:
+            dedup_index.release(name)
+        return False
+    os.unlink(upload.path)
+    return True
 
-    def write_paste_form(self):
-        self.send_response(200)
-        message = """<!doctype html>
-            <html>
-            <head>
-                <title>LocalPaste CLI and web pastebin</title>
-                <style type='text/css'>
-                    .container {
-                        margin: auto;
-                        width: 70%;
-                        height: 90%;
-                        min-width: 500px;
-                        max-width: 1000px;
-                    }
-                    .textarea {
-                        width: 100%;
-                        height: 100%;
-                    }
-                    .alignright {
-                        float: right;
-                    }
-                </style>
-            </head>
-            <body>
-                <form method='post' action="?">
-                    <div class='container'>
-                        <textarea class='textarea' name='data' rows='15' cols='50' ></textarea> <br />
-                        <input class='alignright' type='submit' value='Paste' />
-                    </div>
-                </form>
-            </body>
-            </html>"""
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.send_header("Content-Length", str(len(message)))
-        self.end_headers()
-        self.wfile.write(message.encode(data_encoding))
+# remove a paste from the disk and from memory; returns False if it was already gone
+def delete_paste(name):
+    deleted = False
+    if small_store is not None:
+        deleted = small_store.delete(name)
+    for path, encoding in paste_files(name):
+        try:
+            os.unlink(path)
+            deleted = True
+        except FileNotFoundError:
+            pass
+    if deleted or paste_index.contains(name):
+        paste_index.remove(name)
+    name_index.discard(name)
+    paste_cache.discard(name)
+    if args.dedup:
+        dedup_index.release(name)
+    return deleted
+
+# which process of --processes this is; only the first one does the startup work that reads the whole datadir
+process_slot = 0
+
+# An append-only file of "VALUE NAME" lines in the datadir, for facts about pastes that can't be worked out from the files.
+# Lines are short and the file is opened for appending, so lines written by several processes don't mix.
+class Journal:
+    def __init__(self, filename):
+        self.path = os.path.join(args.datadir, filename)
+        self.file = None
+        self.lock = threading.Lock()
+        # the inode of the file and how much of it was read, for read_new()
+        self.inode = None
+        self.offset = 0
+        self.read_lock = threading.Lock()
     
-    def write_simple_error(code, message):
-        self.send_response(400)
-        self.send_header("Content-Type", "text/plain; charset=utf-8")
-        self.send_header("Content-Length", str(len(message)))
-        self.end_headers()
-        self.wfile.write(message.encode(data_encoding))
-        
-    # For showing the pasted data
-    def do_GET(self):
-        path = self.path[1:]
-        
-        if len(path) == 0:
-            # for blank path, show help and a paste form
-            self.write_paste_form()
-            return
-        
-        path_regex = re.compile("^[a-zA-Z0-9+=]+$")
-        m = path_regex.match(path)
-        if not m:
-            logdebug("rejecting request: client = %s, path = %s" % (self.client_address, self.path))
-            self.write_simple_error(400, "invalid file name")
-            return
-        
-        data = read_file(path)
-        logdebug("accepting request: client = %s, path = %s, len(data) = %s" % (self.client_address, self.path, len(data)))
+    # the name -> value pairs in data, where later lines win; an unfinished last line is left out
+    def parse(self, data):
+        values = {}
+        for line in data[:data.rfind(b"\n") + 1].decode("utf-8", "surrogateescape").splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                values[fields[1]] = fields[0]
+        return values
+    
+    # Read the journal into a dict of name -> value, where later lines win, and rewrite it without the pastes that are gone.
+    # This runs at startup, after paste_index is loaded, and before any other process can append to it, unless this process
+    # is taking over from another one.
+    def load(self):
+        data = b""
+        try:
+            with open(self.path, "rb") as f:
+                self.inode = os.fstat(f.fileno()).st_ino
+                data = f.read()
+        except FileNotFoundError:
+            pass
+        self.offset = data.rfind(b"\n") + 1
         
-        if( len(data) == 0 ):
-            self.write_simple_error(400, "empty data")
-            return
+        values = {name: value for name, value in self.parse(data).items() if paste_index.contains(name)}
+        if old_server_pid is not None:
+            # the process this one replaces is still appending to it
+            logdebug("loaded %s entries from %s" % (len(values), self.path))
+            return values
         
-        self.send_response(200)
-        self.end_headers()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for name, value in values.items():
+                f.write("%s %s\n" % (value, name))
+            f.flush()
+            st = os.fstat(f.fileno())
+            self.inode = st.st_ino
+            self.offset = st.st_size
+        chown_to_user(tmp_path)
+        os.rename(tmp_path, self.path)
         
-        total = 0
-        while total < len(data):
-            # for some reason, it only writes 2539008 bytes at a time, so just keep trying that amount until done
-            l = self.wfile.write(data[total:total+2539008])
-            total += l
+        logdebug("loaded %s entries from %s" % (len(values), self.path))
+        return values
     
-    def setup(self):
+    def append(self, value, name):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write("%s %s\n" % (value, name))
+            self.file.flush()
+    
+    # the name -> value pairs that any process appended since load() or the previous call; a journal replaced by a newer
+    # server is read from the start, since reading an entry again changes nothing
+    def read_new(self):
+        with self.read_lock:
+            try:
+                with open(self.path, "rb") as f:
+                    inode = os.fstat(f.fileno()).st_ino
+                    if inode != self.inode:
+                        self.inode = inode
+                        self.offset = 0
+                    f.seek(self.offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return {}
+            self.offset += data.rfind(b"\n") + 1
+            return self.parse(data)
+
+############################################
+# Dedup
+############################################
+
+# Identical pastes are stored once, as a blob named by the SHA-256 of the content, and every paste name is a hard link to its blob.
+# The link count of the blob is its reference count across all processes, so the blob is removed when the last name goes.
+# The journal maps names to blob file names (the digest plus the compression suffix), so a deleted name can find its blob.
+class DedupIndex:
+    def __init__(self):
+        self.journal = Journal(".dedup")
+        self.blobs = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+    
+    def blob_path(self, blob):
+        return os.path.join(args.datadir, ".blobs", blob[0:2], blob)
+    
+    def load(self):
+        self.blobs = self.journal.load()
+    
+    def add(self, name, blob):
+        self.journal.append(blob, name)
+        with self.lock:
+            self.blobs[name] = blob
+    
+    # drop the reference from name to its blob, after the name was deleted
+    def release(self, name):
+        with self.lock:
+            if name not in self.blobs:
+                # it was saved by another process after this one loaded the journal
+                self.blobs.update(self.journal.read_new())
+            blob = self.blobs.pop(name, None)
+        if blob is None:
+            return
+        path = self.blob_path(blob)
+        try:
+            if os.stat(path).st_nlink == 1:
+                os.unlink(path)
+                logdebug("removed blob %s" % blob)
+        except FileNotFoundError:
+            pass
+    
+    # remove blobs no name links to any more, eg. after a crash between unlinking a name and its blob
+    def remove_orphans(self):
+        count = 0
+        blobs_dir = os.path.join(args.datadir, ".blobs")
+        if not os.path.isdir(blobs_dir):
+            return
+        for shard in os.scandir(blobs_dir):
+            for entry in os.scandir(shard.path):
+                if entry.stat().st_nlink == 1:
+                    os.unlink(entry.path)
+                    count += 1
+        log("removed %s unused blobs" % count)
+    
+    def start(self):
+        if process_slot == 0:
+            t = threading.Thread(target=self.remove_orphans, name="dedup-orphans")
+            t.daemon = True
+            t.start()
+
+dedup_index = DedupIndex()
+
+# Link the name at path to the blob with the content of upload, making upload the blob if there is none yet.
+# Raises FileExistsError if the name is taken.
+def save_deduplicated(name, upload, path):
+    # identical content compressed with different codecs gets different blobs
+    blob_name = upload.hash.hexdigest() + upload.suffix
+    blob = dedup_index.blob_path(blob_name)
+    while True:
+        try:
+            os.link(upload.path, blob)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            continue
+        except FileExistsError:
+            dedup_index.hits += 1
+            logdebug("upload is identical to blob %s" % blob_name)
+        try:
+            os.link(blob, path)
+        except FileNotFoundError:
+            # the last other name of the blob was deleted in the meantime
+            if not os.path.isfile(blob):
+                continue
+            raise
+        break
+    dedup_index.add(name, blob_name)
+
+############################################
+# Expiry
+############################################
+
+# how often process 0 reads the paste index journal for pastes saved by the other processes
+expiry_follow_interval = 1
+
+# A heap of (expires_at, name, inode) for pastes that will expire, and a thread that deletes them as they come due.
+# Only process 0 has them. It loads the pastes in the paste index in the background when it starts, including when it
+# replaces a process 0 that died, and then adds the ones that any process saves from the paste index journal.
+class ExpiryQueue:
+    def __init__(self):
+        self.heap = []
+        # per-paste expiry times from the ttl parameter and of deduplicated pastes, since they can't be worked out from the file
+        self.journal = Journal(".expiry")
+        self.journaled = {}
+        self.deleted = 0
+        self.cond = threading.Condition()
+    
+    def load_journal(self):
+        self.journaled = {name: float(value) for name, value in self.journal.load().items()}
+    
+    def push(self, expires_at, name, inode):
+        with self.cond:
+            heapq.heappush(self.heap, (expires_at, name, inode))
+            if self.heap[0][1] == name:
+                # the thread might be waiting for something that expires later
+                self.cond.notify()
+    
+    # record the expiry of a paste that was just saved; expires_at comes from the ttl, or is 0 for the default. Process 0
+    # schedules it when it finds the paste in the paste index journal.
+    def add(self, name, expires_at):
+        if expires_at:
+            self.journal.append(expires_at, name)
+            self.journaled[name] = expires_at
+    
+    # when a paste with this mtime expires, or None if it doesn't
+    def expires_at(self, name, mtime):
+        expires_at = self.journaled.get(name)
+        if expires_at is not None:
+            return expires_at
+        # a ttl given to another process is in the paste index journal
+        record = paste_index.get(name)
+        if record is not None and record[2]:
+            return record[2]
+        if args.expire_days > 0:
+            return mtime + args.expire_days*24*3600
+        return None
+    
+    # schedule a paste from its paste index record; returns False if it doesn't expire
+    def schedule(self, name, record):
+        size, mtime, expires_at, inode = record
+        # an index made by --rebuild-index doesn't know the ttl of a paste, but the journal does
+        expires_at = self.journaled.get(name, expires_at)
+        if not expires_at:
+            if args.expire_days == 0:
+                return False
+            expires_at = mtime + args.expire_days*24*3600
+        self.push(expires_at, name, inode)
+        return True
+    
+    # the pastes saved by any process, from paste_index.refresh()
+    def schedule_changes(self, changes):
+        for name, record in changes.items():
+            if record is not None:
+                self.schedule(name, record)
+    
+    # Add the pastes in the datadir. The index of a process that replaces one that died is from when the server started,
+    # so it is brought up to date first. A paste saved in the meantime might be pushed twice, which run() copes with.
+    def load_existing(self):
+        start = time.time()
+        paste_index.refresh()
+        count = 0
+        for name, record in paste_index.iter_records():
+            count += self.schedule(name, record)
+        log("loaded %s pastes into the expiry queue (%.3fs)" % (count, time.time() - start))
+    
+    # schedule the pastes the other processes save, as they add them to the paste index journal
+    def follow(self):
+        while True:
+            time.sleep(expiry_follow_interval)
+            try:
+                paste_index.refresh()
+            except Exception as e:
+                logerror("failed to read the paste index journal: %s" % e)
+    
+    def next_expired(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    return heapq.heappop(self.heap)
+                if self.heap:
+                    self.cond.wait(self.heap[0][0] - now)
+                else:
+                    self.cond.wait()
+    
+    def run(self):
+        while True:
+            expires_at, name, inode = self.next_expired()
+            try:
+                st = stat_paste(name)
+            except FileNotFoundError:
+                continue
+            # the name might have been reused by a newer paste since this one was deleted
+            if st.st_ino != inode:
+                continue
+            if delete_paste(name):
+                self.deleted += 1
+                logdebug("expired paste %s" % name)
+            self.journaled.pop(name, None)
+            # deletions are spread out so a large batch coming due at once doesn't hog the disk
+            time.sleep(1.0 / args.expire_rate)
+    
+    def start(self):
+        # one process deletes the expired pastes of all of them, so none are lost when a process dies
+        if process_slot != 0:
+            return
+        paste_index.on_refresh = self.schedule_changes
+        t = threading.Thread(target=self.load_existing, name="expiry-load")
+        t.daemon = True
+        t.start()
+        t = threading.Thread(target=self.run, name="expiry")
+        t.daemon = True
+        t.start()
+        t = threading.Thread(target=self.follow, name="expiry-follow")
+        t.daemon = True
+        t.start()
+
+expiry_queue = ExpiryQueue()
+
+# get the ttl in seconds from the query string of a POST, or None if there isn't one
+def get_ttl(path):
+    values = parse_qs(urlsplit(path).query).get("ttl")
+    if not values:
+        return None
+    try:
+        ttl = float(values[0])
+    except ValueError:
+        raise MalformedUploadException("ttl must be a number of seconds")
+    if ttl <= 0:
+        raise MalformedUploadException("ttl must be a positive number of seconds")
+    if args.expire_days > 0:
+        # a ttl can only make a paste expire sooner than the configured maximum
+        ttl = min(ttl, args.expire_days*24*3600)
+    return ttl
+
+# start the threads that every serving process needs, after forking and dropping privileges
+def start_background_threads():
+    start_log_writer()
+    paste_index.start()
+    if process_slot == 0:
+        t = threading.Thread(target=remove_stale_uploads, name="stale-uploads")
+        t.daemon = True
+        t.start()
+    expiry_queue.start()
+    if args.metrics_port is not None:
+        start_metrics_server()
+    if args.dedup:
+        dedup_index.start()
+
+############################################
+# Logging
+############################################
+
+# log records waiting for the writer; when it can't keep up, further records are dropped rather than making requests wait
+log_queue_size = 100000
+
+# most records written with one write() call
+log_batch_size = 1000
+
+# The access log file, appended to by the log writer of every process, and rotated by whichever process sees it grow too big.
+class AccessLogFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        # after a failed rotation, it is tried again once the file grows past this
+        self.rotate_size = args.access_log_max_bytes
+    
+    def open(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "ab")
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        if args.user and os.getuid() == 0:
+            # the server rotates it after dropping privileges
+            import pwd
+            target_user = pwd.getpwnam(args.user)
+            os.chown(self.path, target_user.pw_uid, target_user.pw_gid)
+    
+    def write(self, data):
+        # another process may have rotated it; this is once per batch of lines, not per request
+        try:
+            if os.stat(self.path).st_ino != self.inode:
+                self.open()
+        except FileNotFoundError:
+            self.open()
+        # one write() per batch, and O_APPEND, so the lines from several processes don't end up inside each other
+        os.write(self.file.fileno(), data)
+        if args.access_log_max_bytes and os.fstat(self.file.fileno()).st_size > self.rotate_size:
+            self.rotate()
+    
+    def rotate(self):
+        # the lock is on the file that is about to be renamed, so other processes wait here, and then find the new file
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                st = None
+            if st is not None and st.st_ino == self.inode:
+                for n in range(args.access_log_backups - 1, 0, -1):
+                    try:
+                        os.rename("%s.%s" % (self.path, n), "%s.%s" % (self.path, n + 1))
+                    except FileNotFoundError:
+                        pass
+                if args.access_log_backups > 0:
+                    os.rename(self.path, self.path + ".1")
+                else:
+                    os.unlink(self.path)
+        except OSError as e:
+            logerror("failed to rotate %s: %s" % (self.path, e))
+            self.rotate_size = os.fstat(self.file.fileno()).st_size + args.access_log_max_bytes
+            return
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.rotate_size = args.access_log_max_bytes
+        self.open()
+
+access_log_file = None
+
+# access log format -> (second, formatted time)
+access_time_cache = {}
+
+def format_access_time(when, fmt):
+    second = int(when)
+    cached = access_time_cache.get(fmt)
+    if cached is None or cached[0] != second:
+        if fmt == "json":
+            text = datetime.datetime.fromtimestamp(second).astimezone().isoformat()
+        else:
+            text = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(second))
+        cached = (second, text)
+        access_time_cache[fmt] = cached
+    return cached[1]
+
+def format_access_record(record):
+    when, client, requestline, status, seconds, received, sent, referer, user_agent = record
+    if args.access_log_format == "json":
+        return json.dumps({"time": format_access_time(when, "json"), "client": client, "request": requestline,
+                           "status": status, "duration_ms": round(seconds * 1000, 3),
+                           "bytes_received": received, "bytes_sent": sent,
+                           "referer": referer, "user_agent": user_agent})
+    def quote(value):
+        if value is None:
+            return "-"
+        return value.replace("\\", "\\\\").replace('"', '\\"')
+    return '%s - - [%s] "%s" %s %s "%s" "%s"' % (
+        client, format_access_time(when, "combined"), quote(requestline), status, sent or "-", quote(referer), quote(user_agent))
+
+# The writer thread: takes whatever records are waiting, formats them, and writes them with one write() per destination.
+# A record is (stream, line) for a log line, or (None, access_record) for a request.
+class LogWriter:
+    def __init__(self):
+        self.queue = queue.Queue(log_queue_size)
+        self.dropped = 0
+        self.thread = None
+    
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+    
+    def write(self, records):
+        lines = collections.defaultdict(list)
+        access = []
+        for stream, record in records:
+            if stream is None:
+                access.append(format_access_record(record))
+            else:
+                lines[stream].append(record)
+        if self.dropped:
+            dropped = self.dropped
+            self.dropped -= dropped
+            lines[sys.stdout].append("%s: WARNING: dropped %s log lines because the log queue was full" % (get_timestamp_str(), dropped))
+        
+        for stream, stream_lines in lines.items():
+            try:
+                stream.write("\n".join(stream_lines) + "\n")
+                stream.flush()
+            except OSError:
+                pass
+        if access:
+            try:
+                access_log_file.write(("\n".join(access) + "\n").encode("utf-8", "replace"))
+            except OSError as e:
+                sys.stderr.write("failed to write to %s: %s\n" % (access_log_file.path, e))
+    
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < log_batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            self.write([record for record in records if record is not None])
+            if stop:
+                return
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="log writer")
+        self.thread.daemon = True
+        self.thread.start()
+    
+    # writes what is still queued; later log lines are written directly
+    def stop(self):
+        global log_writer
+        if log_writer is self:
+            log_writer = None
+        try:
+            self.queue.put(None, timeout=1)
+        except queue.Full:
+            return
+        self.thread.join(5)
+
+def start_log_writer():
+    global log_writer
+    writer = LogWriter()
+    writer.start()
+    log_writer = writer
+
+def stop_log_writer():
+    if log_writer is not None:
+        log_writer.stop()
+
+def open_access_log():
+    global access_log_file
+    if args.access_log is None:
+        return
+    access_log_file = AccessLogFile(args.access_log)
+    try:
+        access_log_file.open()
+    except OSError as e:
+        logerror("failed to open the access log: %s" % e)
+        exit(1)
+
+# Logs a request once its response has been sent: to the access log, or else to stderr in the same format http.server uses.
+def log_access(client_address, requestline, headers, status, seconds, received, sent):
+    if access_log_file is None:
+        year, month, day, hh, mm, ss, x, y, z = time.localtime()
+        date = "%02d/%3s/%04d %02d:%02d:%02d" % (day, http.server.BaseHTTPRequestHandler.monthname[month], year, hh, mm, ss)
+        write_log("%s - - [%s] \"%s\" %s -" % (client_address[0], date, requestline, status), sys.stderr)
+        return
+    referer = None
+    user_agent = None
+    if headers is not None:
+        referer = headers["Referer"]
+        user_agent = headers["User-Agent"]
+    record = (time.time(), client_address[0], requestline, status, seconds, received, sent, referer, user_agent)
+    if log_writer is not None:
+        log_writer.put((None, record))
+    else:
+        access_log_file.write((format_access_record(record) + "\n").encode("utf-8", "replace"))
+
+############################################
+# Metrics
+############################################
+
+# upper bounds in seconds of the latency histogram buckets
+metrics_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+    def __init__(self):
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(metrics_buckets) + 1)
+        self.sum = 0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(metrics_buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def render(self, name, labels, out):
+        total = 0
+        for bucket, count in zip(metrics_buckets, self.counts):
+            total += count
+            out.append('%s_bucket{%sle="%s"} %s' % (name, labels, bucket, total))
+        out.append('%s_bucket{%sle="+Inf"} %s' % (name, labels, self.count))
+        labels = labels.rstrip(",")
+        out.append('%s_sum{%s} %s' % (name, labels, self.sum))
+        out.append('%s_count{%s} %s' % (name, labels, self.count))
+
+# times a block of code as one stage of handling a request
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe_stage(self.stage, time.perf_counter() - self.start)
+
+# Counters and histograms for the requests of this process, in the prometheus text format.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.request_durations = collections.defaultdict(Histogram)
+        self.stage_durations = collections.defaultdict(Histogram)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+    
+    def observe_request(self, method, status, seconds, received, sent):
+        with self.lock:
+            self.requests[(method, status)] += 1
+            self.request_durations[method].observe(seconds)
+            self.bytes_received += received
+            self.bytes_sent += sent
+    
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            self.stage_durations[stage].observe(seconds)
+    
+    def stage(self, stage):
+        return StageTimer(self, stage)
+    
+    def render(self):
+        out = []
+        def metric(name, kind, description):
+            out.append("# HELP localpaste_%s %s" % (name, description))
+            out.append("# TYPE localpaste_%s %s" % (name, kind))
+        
+        with self.lock:
+            metric("requests_total", "counter", "Requests handled, by method and status.")
+            for (method, status), count in sorted(self.requests.items()):
+                out.append('localpaste_requests_total{method="%s",status="%s"} %s' % (method, status, count))
+            metric("request_duration_seconds", "histogram", "Time from reading the request headers until the response was sent.")
+            for method, histogram in sorted(self.request_durations.items()):
+                histogram.render("localpaste_request_duration_seconds", 'method="%s",' % method, out)
+            metric("stage_duration_seconds", "histogram", "Time spent in each stage of handling requests.")
+            for stage, histogram in sorted(self.stage_durations.items()):
+                histogram.render("localpaste_stage_duration_seconds", 'stage="%s",' % stage, out)
+            metric("received_bytes_total", "counter", "Request body bytes received.")
+            out.append("localpaste_received_bytes_total %s" % self.bytes_received)
+            metric("sent_bytes_total", "counter", "Response body bytes sent.")
+            out.append("localpaste_sent_bytes_total %s" % self.bytes_sent)
+        
+        with paste_cache.lock:
+            metric("cache_hits_total", "counter", "Paste reads served from the cache.")
+            out.append("localpaste_cache_hits_total %s" % paste_cache.hits)
+            metric("cache_misses_total", "counter", "Paste reads not found in the cache.")
+            out.append("localpaste_cache_misses_total %s" % paste_cache.misses)
+            metric("cache_evictions_total", "counter", "Pastes evicted from the cache.")
+            out.append("localpaste_cache_evictions_total %s" % paste_cache.evictions)
+            metric("cache_bytes", "gauge", "Bytes of pastes in the cache.")
+            out.append("localpaste_cache_bytes %s" % paste_cache.size)
+            metric("cache_pastes", "gauge", "Pastes in the cache.")
+            out.append("localpaste_cache_pastes %s" % len(paste_cache.entries))
+        
+        with render_cache.lock:
+            metric("render_cache_hits_total", "counter", "Html views served from the render cache.")
+            out.append("localpaste_render_cache_hits_total %s" % render_cache.hits)
+            metric("render_cache_misses_total", "counter", "Html views that had to be rendered.")
+            out.append("localpaste_render_cache_misses_total %s" % render_cache.misses)
+            metric("render_cache_bytes", "gauge", "Bytes of html in the render cache.")
+            out.append("localpaste_render_cache_bytes %s" % render_cache.size)
+        
+        metric("upload_bytes_in_flight", "gauge", "Content-Length of the uploads being read.")
+        out.append("localpaste_upload_bytes_in_flight %s" % upload_admission.in_flight)
+        metric("uploads_refused_total", "counter", "Uploads refused by --max-upload-bytes-in-flight.")
+        out.append("localpaste_uploads_refused_total %s" % upload_admission.refused)
+        metric("rate_limit_clients", "gauge", "Client addresses with a rate limit bucket.")
+        out.append("localpaste_rate_limit_clients %s" % len(rate_limiter.buckets))
+        metric("pastes", "gauge", "Pastes known to this process.")
+        out.append("localpaste_pastes %s" % len(paste_index))
+        metric("expired_total", "counter", "Pastes deleted by expiry.")
+        out.append("localpaste_expired_total %s" % expiry_queue.deleted)
+        metric("expiry_queue_length", "gauge", "Pastes waiting to expire.")
+        out.append("localpaste_expiry_queue_length %s" % len(expiry_queue.heap))
+        if args.dedup:
+            metric("dedup_hits_total", "counter", "Uploads that were identical to a stored paste.")
+            out.append("localpaste_dedup_hits_total %s" % dedup_index.hits)
+        
+        st = os.statvfs(args.datadir)
+        metric("disk_free_bytes", "gauge", "Free space on the filesystem of the datadir.")
+        out.append("localpaste_disk_free_bytes %s" % (st.f_bavail * st.f_frsize))
+        metric("disk_size_bytes", "gauge", "Size of the filesystem of the datadir.")
+        out.append("localpaste_disk_size_bytes %s" % (st.f_blocks * st.f_frsize))
+        metric("disk_free_inodes", "gauge", "Free inodes on the filesystem of the datadir.")
+        out.append("localpaste_disk_free_inodes %s" % st.f_favail)
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    # scrapes would fill up the log
+    def log_message(self, format, *log_args):
+        pass
+
+def start_metrics_server():
+    port = args.metrics_port + process_slot
+    # the process this one replaces keeps its metrics port until it has drained
+    deadline = time.time()
+    if old_server_pid is not None:
+        deadline += args.drain_timeout + args.keep_alive_timeout
+    while True:
+        try:
+            server = http.server.ThreadingHTTPServer((args.metrics_address, port), MetricsHandler)
+            break
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+    t = threading.Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    log("serving metrics on http://%s:%s/metrics" % (args.metrics_address, port))
+
+############################################
+# Admission control
+############################################
+
+# how often buckets of clients that went quiet are forgotten, in seconds
+rate_limit_prune_interval = 60
+
+# Token buckets of requests and upload bytes for each client address. Tokens come back at the rate, up to the burst;
+# a request needs a token, and an upload needs as many byte tokens as its Content-Length, or a full bucket for a bigger one,
+# which then leaves the bucket in debt.
+class RateLimiter:
+    def __init__(self, request_rate, request_burst, byte_rate):
+        self.request_rate = request_rate
+        self.request_burst = request_burst
+        self.byte_rate = byte_rate
+        # a second's worth, but at least the biggest upload, so that one can always get through a full bucket
+        self.byte_burst = max(byte_rate, args.data_max_size)
+        # address -> [request tokens, byte tokens, time of the last update]
+        self.buckets = {}
+        self.pruned = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def enabled(self):
+        return self.request_rate > 0 or self.byte_rate > 0
+    
+    # take the tokens for a request with a body of size bytes; returns 0 if it may go ahead, or else the seconds to wait
+    def take(self, address, size):
+        if not self.enabled():
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(address)
+            if bucket is None:
+                bucket = [self.request_burst, self.byte_burst, now]
+                self.buckets[address] = bucket
+            elapsed = now - bucket[2]
+            bucket[0] = min(self.request_burst, bucket[0] + elapsed * self.request_rate)
+            bucket[1] = min(self.byte_burst, bucket[1] + elapsed * self.byte_rate)
+            bucket[2] = now
+            
+            wait = 0
+            if self.request_rate > 0 and bucket[0] < 1:
+                wait = (1 - bucket[0]) / self.request_rate
+            needed = min(size, self.byte_burst)
+            if self.byte_rate > 0 and bucket[1] < needed:
+                wait = max(wait, (needed - bucket[1]) / self.byte_rate)
+            if wait > 0:
+                return wait
+            if self.request_rate > 0:
+                bucket[0] -= 1
+            if self.byte_rate > 0:
+                bucket[1] -= size
+            
+            if now - self.pruned > rate_limit_prune_interval:
+                self.prune(now)
+        return 0
+    
+    # forget the clients whose buckets have filled up again, since a new bucket starts out full anyway
+    def prune(self, now):
+        self.pruned = now
+        for address, bucket in list(self.buckets.items()):
+            elapsed = now - bucket[2]
+            if ((self.request_rate == 0 or bucket[0] + elapsed * self.request_rate >= self.request_burst) and
+                (self.byte_rate == 0 or bucket[1] + elapsed * self.byte_rate >= self.byte_burst)):
+                del self.buckets[address]
+
+rate_limiter = RateLimiter(args.rate_limit_requests, args.rate_limit_burst, args.rate_limit_bytes)
+
+# The Content-Length of the uploads being read, so a burst of big uploads is refused up front instead of all of them
+# being written to disk at once. One upload is always let in, even if it is bigger than the limit.
+class UploadAdmission:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+    
+    def acquire(self, size):
+        with self.lock:
+            if self.max_bytes and self.in_flight > 0 and self.in_flight + size > self.max_bytes:
+                self.refused += 1
+                return False
+            self.in_flight += size
+            return True
+    
+    def release(self, size):
+        with self.lock:
+            self.in_flight -= size
+
+upload_admission = UploadAdmission(args.max_upload_bytes_in_flight)
+
+# the Response for a client over its rate limit, or None if the request may go ahead
+def rate_limit_response(client_address, size):
+    wait = rate_limiter.take(client_address[0], size)
+    if wait == 0:
+        return None
+    logdebug("rate limited: client = %s, wait = %.3f" % (client_address, wait))
+    response = text_response(429, "too many requests")
+    response.add_header("Retry-After", str(int(math.ceil(wait))))
+    return response
+
+############################################
+# Request handling, shared by the server engines
+############################################
+
+# A response worked out by the request handling code, for an engine to send.
+# The body is either bytes, count bytes of an open file starting at offset, or an iterator of bytes chunks for a body of unknown length.
+class Response:
+    def __init__(self, status, body=b"", content_type=None):
+        self.status = status
+        self.headers = []
+        self.body = body
+        self.file = None
+        self.offset = 0
+        self.count = 0
+        self.chunks = None
+        # the total length of chunks, if it is known
+        self.chunks_length = None
+        # whether the connection can't be used for another request afterwards
+        self.close = False
+        if content_type:
+            self.add_header("Content-Type", content_type)
+    
+    def add_header(self, key, value):
+        self.headers.append((key, value))
+    
+    def set_file(self, f, offset, count):
+        self.file = f
+        self.offset = offset
+        self.count = count
+    
+    # None if the length is unknown, so the end of the body has to be marked by closing the connection
+    def content_length(self):
+        if self.file is not None:
+            return self.count
+        if self.chunks is not None:
+            return self.chunks_length
+        return len(self.body)
+    
+    # release the file or iterator behind the body, after it was sent or if sending failed
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+        if self.chunks is not None and hasattr(self.chunks, "close"):
+            self.chunks.close()
+
+def text_response(status, message):
+    return Response(status, message.encode(data_encoding), "text/plain; charset=utf-8")
+
+def paste_form_response():
+    message = """<!doctype html>
+        <html>
+        <head>
+            <title>LocalPaste CLI and web pastebin</title>
+            <style type='text/css'>
+                .container {
+                    margin: auto;
+                    width: 70%;
+                    height: 90%;
+                    min-width: 500px;
+                    max-width: 1000px;
+                }
+                .textarea {
+                    width: 100%;
+                    height: 100%;
+                }
+                .alignright {
+                    float: right;
+                }
+            </style>
+        </head>
+        <body>
+            <form method='post' action="?">
+                <div class='container'>
+                    <textarea class='textarea' name='data' rows='15' cols='50' ></textarea> <br />
+                    <input class='alignright' type='submit' value='Paste' />
+                    Add .html to the url of a paste to view it with line numbers and syntax highlighting.
+                </div>
+            </form>
+        </body>
+        </html>"""
+    return Response(200, message.encode(data_encoding), "text/html; charset=utf-8")
+
+# A paste upload. The engine calls start(), then feeds the body to it as it arrives, then calls finish(), or abort() on an error.
+class UploadRequest:
+    def __init__(self, client_address, path, headers):
+        self.client_address = client_address
+        self.path = path
+        self.headers = headers
+        self.length = 0
+        self.ttl = None
+        # one UploadFile per paste in the body, in order
+        self.uploads = []
+        self.parser = None
+        self.feed_time = 0
+        # the bytes taken from upload_admission
+        self.admitted = 0
+    
+    # returns a Response if the upload is refused before the body is read, else None
+    def start(self):
+        logdebug("UploadRequest.start() called")
+        log("client %s - connected" % str(self.client_address))
+        
+        try:
+            self.length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            return text_response(411, "Content-Length is required")
+        if self.length > args.data_max_size:
+            return text_response(400, "Maximum content-length is %s, but recieved %s" % (args.data_max_size, self.length))
+        
+        try:
+            self.ttl = get_ttl(self.path)
+        except MalformedUploadException as e:
+            return text_response(400, e.message)
+        multi = parse_qs(urlsplit(self.path).query).get("multi", ["0"])[0] not in ("", "0")
+        
+        # both are checked before the body is read, so a refused upload costs no disk bandwidth
+        response = rate_limit_response(self.client_address, self.length)
+        if response is not None:
+            return response
+        if not upload_admission.acquire(self.length):
+            logdebug("too many uploads in flight: client = %s, length = %s" % (self.client_address, self.length))
+            response = text_response(503, "too many uploads at once; try again later")
+            response.add_header("Retry-After", "1")
+            return response
+        self.admitted = self.length
+        
+        try:
+            self.parser = make_upload_parser(self.headers["Content-Type"], self.new_upload, multi)
+        except (UnsupportedContentTypeException, MalformedUploadException) as e:
+            self.abort()
+            status = 500 if isinstance(e, UnsupportedContentTypeException) else 400
+            return text_response(status, e.message)
+        return None
+    
+    # with the asyncio engine, the body is fed in as it arrives; the time spent parsing and writing it counts as read_data
+    def feed(self, data):
+        start = time.perf_counter()
+        self.parser.feed(data)
+        self.feed_time += time.perf_counter() - start
+    
+    def new_upload(self):
+        if len(self.uploads) >= args.batch_max_pastes:
+            raise MalformedUploadException("more than %s pastes in one upload" % args.batch_max_pastes)
+        upload = UploadFile()
+        self.uploads.append(upload)
+        return upload
+    
+    def abort(self):
+        for upload in self.uploads:
+            upload.discard()
+        self.release()
+    
+    def release(self):
+        upload_admission.release(self.admitted)
+        self.admitted = 0
+    
+    # with the threaded engine, the body is read here from a blocking file
+    def read_from(self, file):
+        try:
+            with metrics.stage("read_data"):
+                read_data(file, self.length, self.parser)
+        except MalformedUploadException as e:
+            return self.fail(e)
+        except:
+            # eg. a timeout from a client that sent less than its Content-Length
+            self.abort()
+            raise
+        return self.finish()
+    
+    # a Response for an upload that turned out to be malformed; the rest of the body is unread, so the connection is closed
+    def fail(self, e):
+        self.abort()
+        logwarn("client %s - %s" % (str(self.client_address), e.message))
+        response = text_response(400, e.message)
+        response.close = True
+        return response
+    
+    def finish(self):
+        try:
+            return self.save()
+        finally:
+            self.release()
+    
+    def save(self):
+        if self.feed_time:
+            metrics.observe_stage("read_data", self.feed_time)
+        try:
+            self.parser.close()
+        except MalformedUploadException as e:
+            return self.fail(e)
+        for upload in self.uploads:
+            upload.close()
+            logdebug("input was %s long" % upload.size)
+        
+        # nothing is saved unless every paste can be
+        if not self.uploads or any(upload.size == 0 for upload in self.uploads):
+            self.abort()
+            return text_response(400, "empty data")
+        
+        # Tell the client the names, with a url in front, one per line in the order of the upload
+        if not hostname_and_port is None:
+            use_hostname_and_port = hostname_and_port
+        else:
+            use_hostname_and_port = self.headers["Host"]
+        urls = []
+        try:
+            for upload in self.uploads:
+                name = self.save_upload(upload)
+                if name is None:
+                    self.abort()
+                    return text_response(500, "failed to generate a unique name")
+                urls.append("%s://%s/%s\r\n" % (args.scheme, use_hostname_and_port, name))
+        except:
+            # the ones that were saved already are left alone by discard()
+            self.abort()
+            raise
+        log("client %s - completed" % str(self.client_address))
+        return text_response(200, "".join(urls))
+    
+    # save one paste under a new name, and return the name, or None if no name was free
+    def save_upload(self, upload):
+        while True:
+            with metrics.stage("generate_name"):
+                name = generate_name()
+            logdebug("name = %s" % name)
+            if name is None:
+                logerror("failed to generate a unique name; %s names are in use" % len(paste_index))
+                return None
+            
+            logdebug("client %s - calling save_file" % str(self.client_address))
+            try:
+                with metrics.stage("save_file"):
+                    saved = save_file(name, upload)
+                if saved:
+                    break
+            except:
+                name_index.discard(name)
+                raise
+            # another process took the name; it stays reserved since it really is in use now
+            logwarn("the file \"%s\" already exists... picking another name" % name)
+        st = stat_paste(name)
+        expires_at = 0
+        if self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        elif args.dedup and args.expire_days > 0:
+            # The mtime of a deduplicated paste is the one of its blob, which can be older than the paste, so the expiry is
+            # recorded like a ttl. The blob isn't touched, since that would change the validators of every name linked to it.
+            expires_at = time.time() + args.expire_days*24*3600
+        paste_index.add(name, st, expires_at)
+        # paste_index has it now
+        name_index.discard(name)
+        expiry_queue.add(name, expires_at)
+        return name
+
+path_regex = re.compile("^[a-zA-Z0-9+=]+$")
+
+# For showing the pasted data
+def get_response(client_address, path, headers):
+    response = rate_limit_response(client_address, 0)
+    if response is not None:
+        return response
+    
+    url = urlsplit(path)
+    if url.path == "/" and url.query:
+        # names never contain "?", so this can't be a paste
+        return batch_response(client_address, url.query)
+    
+    if url.path.endswith(".html"):
+        name = url.path[1:-len(".html")]
+        if not path_regex.match(name):
+            return text_response(400, "invalid file name")
+        return html_response(client_address, name, headers, url.query)
+    
+    path = path[1:]
+    
+    if len(path) == 0:
+        # for blank path, show help and a paste form
+        return paste_form_response()
+    
+    return single_paste_response(client_address, path, headers)
+
+def single_paste_response(client_address, path, headers):
+    m = path_regex.match(path)
+    if not m:
+        logdebug("rejecting request: client = %s, path = /%s" % (client_address, path))
+        return text_response(400, "invalid file name")
+    
+    cached = paste_cache.get(path)
+    if cached is not None:
+        data, encoding, validators = cached
+        logdebug("accepting request from cache: client = %s, path = /%s, size = %s" % (client_address, path, len(data)))
+        return paste_response(headers, path, encoding, validators, data)
+    
+    start = time.perf_counter()
+    if small_store is not None:
+        stored = small_store.get(path)
+        if stored is not None:
+            data, encoding, st = stored
+            metrics.observe_stage("read_file", time.perf_counter() - start)
+            validators = paste_validators(path, st)
+            paste_cache.put(path, data, encoding, validators, expiry_queue.expires_at(path, validators[1]))
+            return paste_response(headers, path, encoding, validators, data)
+    
+    try:
+        f, encoding = open_paste(path)
+    except FileNotFoundError:
+        logdebug("no such paste: client = %s, path = /%s" % (client_address, path))
+        return text_response(404, "not found")
+    
+    try:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        validators = paste_validators(path, st)
+        logdebug("accepting request: client = %s, path = /%s, size = %s" % (client_address, path, size))
+        
+        if( size == 0 ):
+            f.close()
+            return text_response(400, "empty data")
+        
+        if paste_cache.accepts(size):
+            with f:
+                data = f.read()
+            metrics.observe_stage("read_file", time.perf_counter() - start)
+            paste_cache.put(path, data, encoding, validators, expiry_queue.expires_at(path, validators[1]))
+            return paste_response(headers, path, encoding, validators, data)
+        
+        # large pastes are read while they are sent, so this is only the time to open them
+        metrics.observe_stage("read_file", time.perf_counter() - start)
+        return paste_response(headers, path, encoding, validators, None, f, size)
+    except:
+        f.close()
+        raise
+
+# Pastes never change, so the ETag only has to tell apart pastes that had the same name at different times.
+# Returns (etag without the quotes, mtime) for the paste file st.
+def paste_validators(name, st):
+    return ("%s-%x-%x" % (name, st.st_ino, st.st_mtime_ns), st.st_mtime)
+
+# an HTTP date as a unix time, or None if it isn't one
+def parse_http_date(value):
+    if value is None:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+# whether the client already has the representation with this etag and mtime, from If-None-Match or If-Modified-Since
+def not_modified(headers, etag, mtime):
+    if_none_match = headers["If-None-Match"]
+    if if_none_match is not None:
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == "*" or tag == etag:
+                return True
+        return False
+    since = parse_http_date(headers["If-Modified-Since"])
+    return since is not None and int(mtime) <= since
+
+# more ranges than this in one request are answered with the whole paste
+max_ranges = 100
+
+# The byte ranges asked for by the Range header, as a list of (first, last) offsets in a paste of length bytes.
+# None means the whole paste is sent, because there is no usable Range header, or If-Range says the client's copy is outdated.
+# An empty list means none of the ranges are in the paste.
+def get_ranges(headers, etag, mtime, length):
+    value = headers["Range"]
+    if value is None:
+        return None
+    if_range = headers["If-Range"]
+    if if_range is not None:
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            if if_range != etag:
+                return None
+        elif parse_http_date(if_range) != int(mtime):
+            return None
+    
+    unit, sep, specs = value.partition("=")
+    if unit.strip().lower() != "bytes" or not sep:
+        return None
+    specs = specs.split(",")
+    if len(specs) > max_ranges:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition("-")
+        if not sep or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":
+            # the last bytes of the paste
+            if last == "":
+                return None
+            suffix = int(last)
+            if suffix == 0:
+                continue
+            ranges.append((max(length - suffix, 0), length - 1))
+            continue
+        first = int(first)
+        last = int(last) if last != "" else length - 1
+        if first >= length:
+            continue
+        if first > last:
+            return None
+        ranges.append((first, min(last, length - 1)))
+    return ranges
+
+# The Response for the paste name that is stored with the Content-Encoding encoding, either as data in memory, or in the open file f of size bytes.
+# validators is from paste_validators.
+def paste_response(headers, name, encoding, validators, data, f=None, size=None):
+    response = Response(200)
+    etag, mtime = validators
+    send_encoded = encoding is not None and accepts_encoding(headers["Accept-Encoding"], encoding)
+    if encoding is not None:
+        response.add_header("Vary", "Accept-Encoding")
+        if send_encoded:
+            # the compressed and the decompressed paste are different representations, with different ETags
+            etag = "%s-%s" % (etag, encoding)
+    etag = '"%s"' % etag
+    response.add_header("ETag", etag)
+    response.add_header("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+    
+    # the paste never changes, but it only lives until it expires
+    max_age = 365*24*3600
+    expires_at = expiry_queue.expires_at(name, mtime)
+    if expires_at is not None:
+        max_age = max(0, min(max_age, int(expires_at - time.time())))
+    response.add_header("Cache-Control", "public, max-age=%s, immutable" % max_age)
+    
+    if not_modified(headers, etag, mtime):
+        if f is not None:
+            f.close()
+        response.status = 304
+        return response
+    
+    # whether a large compressed paste is decompressed while it is sent
+    stream = False
+    if send_encoded:
+        # the stored data goes out as is, without decompressing and compressing it again
+        response.add_header("Content-Encoding", encoding)
+    elif encoding is not None:
+        if data is not None:
+            data = decompress(encoding, data)
+        else:
+            stream = True
+            size = uncompressed_size(encoding, size, lambda n: os.pread(f.fileno(), n, size - n))
+            if size is None:
+                # without the length, ranges can't be checked
+                response.chunks = decompressed_chunks(encoding, f)
+                return response
+    
+    length = len(data) if data is not None else size
+    response.add_header("Accept-Ranges", "bytes")
+    ranges = get_ranges(headers, etag, mtime, length)
+    if stream and ranges is not None and len(ranges) > 1:
+        # the decompressed paste can only be skipped through forwards, so it is sent in one range at most
+        ranges = None
+    if ranges is None:
+        if data is not None:
+            response.body = data
+        elif stream:
+            response.chunks = decompressed_chunks(encoding, f)
+            response.chunks_length = size
+        else:
+            response.set_file(f, 0, size)
+        return response
+    
+    if not ranges:
+        if f is not None:
+            f.close()
+        response = text_response(416, "requested range not satisfiable")
+        response.add_header("Content-Range", "bytes */%s" % length)
+        return response
+    
+    response.status = 206
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        response.add_header("Content-Range", "bytes %s-%s/%s" % (first, last, length))
+        if data is not None:
+            response.body = data[first:last + 1]
+        elif stream:
+            response.chunks = decompressed_chunks(encoding, f, first, last + 1 - first)
+            response.chunks_length = last + 1 - first
+        else:
+            response.set_file(f, first, last + 1 - first)
+        return response
+    
+    # several ranges go out as the parts of a multipart/byteranges body
+    boundary = secrets.token_hex(16)
+    response.add_header("Content-Type", "multipart/byteranges; boundary=%s" % boundary)
+    parts = []
+    for first, last in ranges:
+        head = "\r\n--%s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n" % (boundary, first, last, length)
+        parts.append((head.encode("latin1"), first, last))
+    end = ("\r\n--%s--\r\n" % boundary).encode("latin1")
+    if data is not None:
+        response.body = b"".join(head + data[first:last + 1] for head, first, last in parts) + end
+    else:
+        response.chunks = range_chunks(f, parts, end)
+        response.chunks_length = sum(len(head) + last + 1 - first for head, first, last in parts) + len(end)
+    return response
+
+# the body of a multipart/byteranges response; parts is a list of (part head, first, last)
+def range_chunks(f, parts, end):
+    with f:
+        for head, first, last in parts:
+            yield head
+            yield from file_chunks(f, first, last + 1 - first)
+        yield end
+
+# count bytes of f from offset, read with pread so several readers can share f
+def file_chunks(f, offset, count):
+    end = offset + count
+    while offset < end:
+        chunk = os.pread(f.fileno(), min(upload_chunk_size, end - offset), offset)
+        if not chunk:
+            raise EOFError("%s ended at %s" % (f.name, offset))
+        yield chunk
+        offset += len(chunk)
+
+# GET /?names=NAME1,NAME2,...&format=tar|multipart sends several pastes in one response, as a tar file, or as the parts
+# of a multipart/mixed body, each named by the paste name. They are always decompressed, and if any of them is missing,
+# the response is a 404 that lists them.
+def batch_response(client_address, query):
+    params = parse_qs(query)
+    names = [name for value in params.get("names", []) for name in value.split(",") if name]
+    batch_format = params.get("format", ["tar"])[0]
+    if not names:
+        return text_response(400, "no names given; use ?names=NAME1,NAME2")
+    if batch_format not in ("tar", "multipart"):
+        return text_response(400, "format must be tar or multipart")
+    if len(names) > args.batch_max_pastes:
+        return text_response(400, "more than %s names" % args.batch_max_pastes)
+    
+    # the single paste responses, with no request headers, so nothing is compressed, conditional or partial
+    no_headers = email.message.Message()
+    pastes = []
+    missing = []
+    try:
+        for name in names:
+            if not path_regex.match(name):
+                missing.append(name)
+                continue
+            response = single_paste_response(client_address, name, no_headers)
+            if response.status != 200:
+                response.finish()
+                missing.append(name)
+                continue
+            if response.file is None and response.chunks is not None and response.chunks_length is None:
+                # a paste decompressed while it is sent has to be read first to know its size
+                response.body = b"".join(response.chunks)
+                response.finish()
+                response.chunks = None
+            mtime = parse_http_date(dict(response.headers).get("Last-Modified")) or time.time()
+            pastes.append((name, mtime, response))
+    except:
+        for name, mtime, response in pastes:
+            response.finish()
+        raise
+    if missing:
+        for name, mtime, response in pastes:
+            response.finish()
+        return text_response(404, "not found: %s" % ", ".join(missing))
+    
+    logdebug("batch: client = %s, pastes = %s, format = %s" % (client_address, len(pastes), batch_format))
+    response = Response(200)
+    parts = []
+    if batch_format == "tar":
+        response.add_header("Content-Type", "application/x-tar")
+        for name, mtime, paste in pastes:
+            info = tarfile.TarInfo(name)
+            info.size = paste.content_length()
+            info.mtime = int(mtime)
+            info.mode = 0o644
+            parts.append((info.tobuf(tarfile.USTAR_FORMAT), paste, bytes(-info.size % tar_block_size)))
+        end = bytes(2 * tar_block_size)
+    else:
+        boundary = secrets.token_hex(16)
+        response.add_header("Content-Type", "multipart/mixed; boundary=%s" % boundary)
+        for name, mtime, paste in pastes:
+            head = "--%s\r\nContent-Disposition: attachment; filename=\"%s\"\r\nContent-Length: %s\r\n\r\n" % (
+                boundary, name, paste.content_length())
+            parts.append((head.encode("latin1"), paste, b"\r\n"))
+        end = ("--%s--\r\n" % boundary).encode("latin1")
+    response.chunks = batch_chunks(parts, end)
+    response.chunks_length = sum(len(head) + paste.content_length() + len(tail) for head, paste, tail in parts) + len(end)
+    return response
+
+# the body of a batch response; parts is a list of (head, paste Response, tail)
+def batch_chunks(parts, end):
+    try:
+        for head, paste, tail in parts:
+            yield head
+            if paste.file is not None:
+                yield from file_chunks(paste.file, paste.offset, paste.count)
+            elif paste.chunks is not None:
+                yield from paste.chunks
+            else:
+                yield paste.body
+            if tail:
+                yield tail
+        yield end
+    finally:
+        for head, paste, tail in parts:
+            paste.finish()
+
+############################################
+# HTML view
+############################################
+
+# changed whenever the html of the pages changes, so cached pages and ETags from before are not used
+html_renderer_version = "1"
+if pygments is not None:
+    html_renderer_version += "-pygments-%s" % pygments.__version__
+
+# the paste is read as stored, and decompressed here, so the ETag it gets is the same for every client
+html_source_headers = email.message.Message()
+html_source_headers["Accept-Encoding"] = ", ".join(encoding for encoding in suffix_encodings.values() if encoding is not None)
+
+# how much of the start of a paste the language is guessed from, when the client doesn't give one
+guess_lexer_bytes = 8192
+
+lang_regex = re.compile("^[a-zA-Z0-9+#._-]*$")
+
+# GET /NAME.html?page=N&lang=LANG shows a page of a paste as html, with line numbers, and highlighted as LANG, or as
+# the language pygments guesses. Each page is rendered once, and then served from render_cache.
+def html_response(client_address, name, headers, query):
+    params = parse_qs(query)
+    lang = params.get("lang", [""])[0]
+    try:
+        page = int(params.get("page", ["1"])[0])
+    except ValueError:
+        return text_response(400, "page must be a number")
+    if page < 1:
+        return text_response(400, "page must be 1 or more")
+    if not lang_regex.match(lang):
+        return text_response(400, "invalid language")
+    
+    source = single_paste_response(client_address, name, html_source_headers)
+    if source.status != 200:
+        return source
+    try:
+        source_headers = dict(source.headers)
+        etag = '"%s-html%s-%s-%s"' % (source_headers["ETag"].strip('"'), html_renderer_version, page, lang)
+        mtime = parse_http_date(source_headers["Last-Modified"])
+        response = Response(200)
+        response.add_header("ETag", etag)
+        response.add_header("Last-Modified", source_headers["Last-Modified"])
+        response.add_header("Cache-Control", source_headers["Cache-Control"])
+        if not_modified(headers, etag, mtime):
+            response.status = 304
+            return response
+        
+        cached = render_cache.get(etag)
+        if cached is not None:
+            body = cached[0]
+        else:
+            with metrics.stage("render"):
+                if source.chunks is not None:
+                    # the body of a chunked response is left empty
+                    source.body = b"".join(source.chunks)
+                reader = source.file or io.BytesIO(source.body)
+                encoding = source_headers.get("Content-Encoding")
+                if encoding is not None:
+                    reader = make_decompressor(encoding, reader)
+                found = read_page(reader, page - 1)
+                if found is None:
+                    return text_response(404, "the paste has no page %s" % page)
+                body = render_page(name, page, lang, *found)
+            render_cache.put(etag, body, None, None)
+        logdebug("html view: client = %s, path = /%s.html, page = %s" % (client_address, name, page))
+        response.add_header("Content-Type", "text/html; charset=utf-8")
+        response.body = body
+        return response
+    finally:
+        source.finish()
+
+# Page page (counting from 0) of the paste read from reader. It starts about page*--render-page-bytes into the paste,
+# after a newline, unless a line is longer than a page. Returns (the start of the paste, the number of the first line
+# of the page, its data, whether another page follows), or None if the paste is shorter.
+def read_page(reader, page):
+    size = args.render_page_bytes
+    head = b""
+    lines = 1
+    # data is the paste from base on
+    base = max(page*size - 1, 0)
+    skip = base
+    while skip > 0:
+        chunk = reader.read(min(upload_chunk_size, skip))
+        if not chunk:
+            return None
+        if len(head) < guess_lexer_bytes:
+            head += chunk[0:guess_lexer_bytes - len(head)]
+        lines += chunk.count(b"\n")
+        skip -= len(chunk)
+    
+    # the rest of this page, and enough of the next one to find where this one ends
+    data = b""
+    while len(data) < 2*size + 1:
+        chunk = reader.read(2*size + 1 - len(data))
+        if not chunk:
+            break
+        data += chunk
+    if len(head) < guess_lexer_bytes:
+        head += data[0:guess_lexer_bytes - len(head)]
+    
+    start = 0
+    if page > 0:
+        start = page_boundary(data, 0, size)
+        if start >= len(data):
+            return None
+        lines += data.count(b"\n", 0, start)
+    end = min(page_boundary(data, (page + 1)*size - 1 - base, size), len(data))
+    return head, lines, data[start:end], end < len(data)
+
+# where the page that nominally starts after index i of data really starts: after the next newline, if there is one within a page
+def page_boundary(data, i, size):
+    newline = data.find(b"\n", i, i + size)
+    if newline < 0:
+        return i + 1
+    return newline + 1
+
+def get_lexer(lang, head):
+    if lang:
+        try:
+            return pygments.lexers.get_lexer_by_name(lang)
+        except pygments.util.ClassNotFound:
+            pass
+    else:
+        try:
+            return pygments.lexers.guess_lexer(head.decode("utf-8", "replace"))
+        except pygments.util.ClassNotFound:
+            pass
+    return pygments.lexers.TextLexer()
+
+# the styles of the highlighted code, the same for every page
+highlight_css = None
+
+# the html of a page of a paste; data is the page, starting at line first_line, and head is the start of the paste, for guessing its language
+def render_page(name, page, lang, head, first_line, data, more):
+    global highlight_css
+    # pastes are mostly utf-8, or ascii
+    text = data.decode("utf-8", "replace")
+    if pygments is not None:
+        formatter = pygments.formatters.HtmlFormatter(linenos="table", linenostart=first_line, lineanchors="L")
+        if highlight_css is None:
+            highlight_css = formatter.get_style_defs(".highlight")
+        code = pygments.highlight(text, get_lexer(lang, head), formatter)
+    else:
+        line_count = text.count("\n") + (0 if text.endswith("\n") else 1)
+        numbers = "\n".join(str(n) for n in range(first_line, first_line + line_count))
+        code = "<table class='highlighttable'><tr><td class='linenos'><pre>%s</pre></td><td class='code'><pre>%s</pre></td></tr></table>" % (
+            numbers, html.escape(text))
+    
+    lang_param = "&lang=%s" % lang if lang else ""
+    links = ["<a href='/%s'>raw</a>" % name, "page %s" % page]
+    if page > 1:
+        links.append("<a href='/%s.html?page=%s%s'>previous</a>" % (name, page - 1, lang_param))
+    if more:
+        links.append("<a href='/%s.html?page=%s%s'>next</a>" % (name, page + 1, lang_param))
+    nav = "<div class='nav'>%s</div>" % " | ".join(links)
+    return ("""<!doctype html>
+<html>
+<head>
+<meta charset='utf-8'>
+<title>%s</title>
+<style type='text/css'>
+body { font-family: sans-serif; }
+pre { margin: 0; }
+.linenos { color: #888; text-align: right; padding-right: 1em; user-select: none; }
+.nav { margin: 0.5em 0; }
+%s
+</style>
+</head>
+<body>
+%s
+%s
+%s
+</body>
+</html>
+""" % (name, highlight_css or "", nav, code, nav)).encode("utf-8")
+
+# the decompressed paste in f, or count bytes of it from offset
+def decompressed_chunks(encoding, f, offset=0, count=None):
+    with f:
+        reader = make_decompressor(encoding, f)
+        while offset > 0:
+            skipped = len(reader.read(min(upload_chunk_size, offset)))
+            if not skipped:
+                return
+            offset -= skipped
+        while count is None or count > 0:
+            chunk = reader.read(upload_chunk_size if count is None else min(upload_chunk_size, count))
+            if not chunk:
+                break
+            if count is not None:
+                count -= len(chunk)
+            yield chunk
+
+############################################
+# TLS
+############################################
+
+# The SSLContext of every https connection, or None for http. It is made before forking, so all the processes
+# have the same session ticket keys, and a client can resume its session with whichever one it gets next time.
+ssl_context = None
+
+# held while the certificate is replaced, since the threaded engine wraps connections in the worker threads
+ssl_context_lock = threading.Lock()
+
+def make_ssl_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    # This expects certfile= to contain both the private key and cert, generated like this:
+    #    openssl req -new -x509 -keyout server.pem -out server.pem -days 365 -nodes
+    # or you can probably just combine them yourself:
+    #    cat server.key server.crt > server.pem
+    # This was based on reading:
+    #    https://gist.github.com/dergachev/7028596
+    #    http://code.activestate.com/recipes/442473-simple-http-server-supporting-ssl-secure-communica/
+    context.load_cert_chain(args.certfile)
+    if args.ssl_ciphers:
+        context.set_ciphers(args.ssl_ciphers)
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    context.set_alpn_protocols(["http/1.1"])
+    if args.ssl_session_tickets == 0:
+        context.options |= ssl.OP_NO_TICKET
+    # TLS 1.3 tickets; TLS 1.2 ones are on unless OP_NO_TICKET is set
+    context.num_tickets = args.ssl_session_tickets
+    return context
+
+# Load the certificate again, eg. after it was renewed, on SIGHUP. The same context is kept, so the session ticket keys
+# stay the same and clients can still resume their sessions.
+def reload_certificate():
+    try:
+        # a bad file would leave the context with a certificate that doesn't match its key, so it is tried out first
+        ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).load_cert_chain(args.certfile)
+        with ssl_context_lock:
+            ssl_context.load_cert_chain(args.certfile)
+    except (OSError, ssl.SSLError) as e:
+        logerror("failed to reload the certificate from %s: %s" % (args.certfile, e))
+        return
+    log("reloaded the certificate from %s" % args.certfile)
+
+def handle_sighup(signum, frame):
+    reload_certificate()
+
+############################################
+# Threaded engine
+############################################
+
+# how long a client may take to send a request, once it started sending one
+request_timeout = 30
+
+class LocalPasteHandler(http.server.BaseHTTPRequestHandler):
+    # keep connections open for more requests; every response has a Content-Length, or else closes the connection
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are separate writes, and with Nagle's algorithm the body would wait for the client to
+    # acknowledge the headers, which it delays while it waits for more data on a connection that stays open
+    disable_nagle_algorithm = True
+    
+    def __init__(self, request, client_address, server):
+        logdebug("LocalPasteHandler.init() called")
+        super(LocalPasteHandler, self).__init__(request, client_address, server)
+    
+    def handle_one_request(self):
+        super().handle_one_request()
+        # an idle connection holds on to a worker thread, so it is only kept open briefly for the next request
+        if not self.close_connection:
+            self.connection.settimeout(args.keep_alive_timeout)
+    
+    # called once the request line arrived
+    def parse_request(self):
+        self.connection.settimeout(request_timeout)
+        return super().parse_request()
+    
+    # 100 Continue is sent by do_POST, once it knows it wants the body
+    def handle_expect_100(self):
+        return True
+        
+    # For handling input
+    def do_POST(self):
+        logdebug("LocalPasteHandler.do_POST() called")
+        start = time.perf_counter()
+        received = 0
+        upload = UploadRequest(self.client_address, self.path, self.headers)
+        response = upload.start()
+        if response is None:
+            if (self.headers["Expect"] or "").lower() == "100-continue" and self.request_version != "HTTP/1.0":
+                self.send_response_only(100)
+                self.end_headers()
+            received = upload.length
+            response = upload.read_from(self.rfile)
+        else:
+            # the body was not read, so the connection can't be used again
+            response.close = True
+        sent = self.write_response(response)
+        seconds = time.perf_counter() - start
+        metrics.observe_request("POST", response.status, seconds, received, sent)
+        log_access(self.client_address, self.requestline, self.headers, response.status, seconds, received, sent)
+        
+    # For showing the pasted data
+    def do_GET(self):
+        start = time.perf_counter()
+        response = get_response(self.client_address, self.path, self.headers)
+        sent = self.write_response(response)
+        seconds = time.perf_counter() - start
+        metrics.observe_request("GET", response.status, seconds, 0, sent)
+        log_access(self.client_address, self.requestline, self.headers, response.status, seconds, 0, sent)
+    
+    # do_GET and do_POST log their requests when the response is sent, so this only logs
+    # the requests that http.server answers itself, like bad request lines and unsupported methods
+    def log_request(self, code='-', size='-'):
+        if isinstance(code, http.HTTPStatus):
+            code = code.value
+        log_access(self.client_address, self.requestline, getattr(self, "headers", None), code, 0, 0, 0)
+    
+    def log_message(self, format, *log_args):
+        write_log("%s - - [%s] %s" % (self.address_string(), self.log_date_time_string(), format % log_args), sys.stderr)
+    
+    # returns the number of body bytes sent
+    def write_response(self, response):
+        try:
+            # send_response without its log_request
+            self.send_response_only(response.status)
+            self.send_header("Server", self.version_string())
+            self.send_header("Date", self.date_time_string())
+            for key, value in response.headers:
+                self.send_header(key, value)
+            length = response.content_length()
+            # a 304 has no body, and a Content-Length would be taken as the length of the paste
+            if length is not None and response.status != 304 and not any(key == "Content-Length" for key, value in response.headers):
+                self.send_header("Content-Length", str(length))
+            if length is None or response.close:
+                self.close_connection = True
+            if draining:
+                # Sets close_connection. A connection is only closed after a response that says so, since the client
+                # might already be sending its next request on it otherwise.
+                self.send_header("Connection", "close")
+            self.end_headers()
+            
+            if response.file is not None:
+                write_file_to_client(self, response.file, response.offset, response.count)
+                return response.count
+            elif response.chunks is not None:
+                sent = 0
+                for chunk in response.chunks:
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                return sent
+            else:
+                self.wfile.write(response.body)
+                return len(response.body)
+        finally:
+            response.finish()
+    
+    def setup(self):
         logdebug("LocalPasteHandler.setup() called")
         super(LocalPasteHandler, self).setup()
 
-class LocalPasteServer(http.server.HTTPServer, socketserver.ThreadingMixIn):
-    def __init__(self, server_address, RequestHandlerClass):
+# Like socketserver.ThreadingMixIn, but with a fixed number of threads taking requests off a bounded queue.
+# When all workers are busy and the queue is full, the accept loop blocks and new connections wait in the
+# kernel listen backlog, instead of starting an unlimited number of threads.
+class WorkerPoolMixIn:
+    workers = 16
+    
+    def start_workers(self):
+        self.request_queue = queue.Queue(self.workers)
+        self.worker_threads = []
+        for n in range(self.workers):
+            t = threading.Thread(target=self.process_request_worker, name="worker-%s" % n)
+            t.daemon = True
+            t.start()
+            self.worker_threads.append(t)
+        logdebug("started %s worker threads" % self.workers)
+    
+    def process_request_worker(self):
+        while True:
+            item = self.request_queue.get()
+            if item is None:
+                break
+            
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+    
+    def process_request(self, request, client_address):
+        if self.workers == 0:
+            super().process_request(request, client_address)
+            return
+        self.request_queue.put((request, client_address))
+    
+    def serve_forever(self, poll_interval=0.5):
+        # threads are started here rather than in __init__ so they are created after forking and dropping privileges
+        if self.workers > 0:
+            self.start_workers()
+        super().serve_forever(poll_interval)
+    
+    def server_close(self):
+        super().server_close()
+        if self.workers > 0 and hasattr(self, "worker_threads"):
+            for t in self.worker_threads:
+                self.request_queue.put(None)
+
+class LocalPasteServer(WorkerPoolMixIn, socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # a stuck thread-per-request client should not keep the process alive on exit
+    daemon_threads = True
+    # the default listen backlog of 5 overflows with a few clients connecting at once, and each dropped SYN costs the client a 1s retransmit
+    request_queue_size = 1024
+    
+    def __init__(self, server_address, RequestHandlerClass, sock=None):
         # no idea why this syntax doesn't work
         #super(LocalPasteServer, self).__init__(self, server_address, RequestHandlerClass)
         # this one works
-        http.server.HTTPServer.__init__(self, server_address, RequestHandlerClass)
-        
-        if args.scheme == "https":
-            # This expects certfile= to contain both the private key and cert, generated like this:
-            #    openssl req -new -x509 -keyout server.pem -out server.pem -days 365 -nodes
-            # or you can probably just combine them yourself:
-            #    cat server.key server.crt > server.pem
-            # This was based on reading:
-            #    https://gist.github.com/dergachev/7028596
-            #    http://code.activestate.com/recipes/442473-simple-http-server-supporting-ssl-secure-communica/
-            self.socket = ssl.wrap_socket(self.socket, certfile=args.certfile, server_side=True)
+        http.server.HTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate=sock is None)
+        if sock is not None:
+            # the listening socket of the process this one replaces
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+        self.workers = args.workers
+        # connections accepted and not closed yet, for drain()
+        self.active = 0
+        self.active_lock = threading.Lock()
+    
+    def process_request(self, request, client_address):
+        with self.active_lock:
+            self.active += 1
+        super().process_request(request, client_address)
+    
+    def shutdown_request(self, request):
+        super().shutdown_request(request)
+        with self.active_lock:
+            self.active -= 1
+    
+    # called by the SIGTERM handler, in the thread running serve_forever()
+    def start_draining(self):
+        global draining
+        if draining:
+            return
+        draining = True
+        log("draining: no new connections are accepted, and open ones are closed after their current request")
+        # shutdown() waits for serve_forever() to return, so it can't run in this thread
+        threading.Thread(target=self.shutdown, name="shutdown").start()
+    
+    def serve_forever(self, poll_interval=0.5):
+        # With --processes, and while a new server takes over, other processes accept from the same socket, and can take
+        # the connection select() woke this one up for. A blocking accept() would then wait for the next connection, and
+        # a draining process never gets one. _handle_request_noblock ignores the error of a non-blocking accept() instead.
+        self.socket.setblocking(False)
+        super().serve_forever(poll_interval)
+        # shutdown() was called by start_draining()
+        self.drain()
+    
+    # close the listening socket, and wait up to --drain-timeout for the connections to finish; idle keep-alive
+    # connections take up to --keep-alive-timeout
+    def drain(self):
+        self.socket.close()
+        deadline = time.time() + args.drain_timeout
+        while self.active > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        if self.active > 0:
+            logwarn("%s connections were still open after %ss of draining" % (self.active, args.drain_timeout))
+        else:
+            log("drained")
 
     # adding a timeout like in http://stackoverflow.com/questions/10003866/http-server-hangs-while-accepting-packets
     def finish_request(self, request, client_address):
         # timeout should only happen if content-length header is wrong
-        request.settimeout(30)
-        # "super" can not be used because BaseServer is not created from object
-        http.server.HTTPServer.finish_request(self, request, client_address)
+        request.settimeout(request_timeout)
+        if ssl_context is None:
+            # "super" can not be used because BaseServer is not created from object
+            http.server.HTTPServer.finish_request(self, request, client_address)
+            return
+        
+        # The TLS handshake runs here, in the worker thread, instead of in accept() on the one thread that accepts
+        # every connection. The original socket is detached by wrap_socket, so shutdown_request() leaves it alone.
+        try:
+            with ssl_context_lock:
+                request = ssl_context.wrap_socket(request, server_side=True, do_handshake_on_connect=False)
+            request.do_handshake()
+        except (ssl.SSLError, OSError) as e:
+            logdebug("TLS handshake with %s failed: %s" % (str(client_address), e))
+            request.close()
+            return
+        try:
+            http.server.HTTPServer.finish_request(self, request, client_address)
+        finally:
+            request.close()
+
+############################################
+# asyncio engine
+############################################
+
+# how long an idle keep-alive connection, or a client in the middle of sending a request, may keep a connection open
+asyncio_timeout = 30
+
+# longest request line plus headers accepted by the asyncio engine
+asyncio_max_header_size = 64*1024
+
+# One connection of the asyncio engine; it serves requests until the client or a response closes it.
+# Anything that touches the disk runs in the worker threads, so a slow disk doesn't hold up the other connections.
+class AsyncioConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info("peername")
+        self.loop = asyncio.get_running_loop()
+        self.requests = 0
+        # asyncio only sets this itself for sockets created with IPPROTO_TCP, which socket.create_server doesn't do,
+        # and without it a response written in two parts waits for the delayed ack of the first part on keep-alive connections
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    def run_in_worker(self, function, *function_args):
+        return self.loop.run_in_executor(None, function, *function_args)
+    
+    async def serve(self):
+        try:
+            while await self.serve_request():
+                pass
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writer.close()
+    
+    # returns whether the connection can be kept open for another request
+    async def serve_request(self):
+        # a new connection gets the time for a whole request, an idle one only --keep-alive-timeout
+        timeout = asyncio_timeout if self.requests == 0 else args.keep_alive_timeout
+        self.requests += 1
+        try:
+            head = await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            # the client closed the connection between requests, or kept it idle too long
+            return False
+        except asyncio.LimitOverrunError:
+            log_access(self.client_address, "-", None, 431, 0, 0, 0)
+            await self.write_response(text_response(431, "request headers too large"), "HTTP/1.1", True)
+            return False
+        
+        requestline, sep, header_bytes = head.partition(b"\r\n")
+        requestline = requestline.decode("latin1")
+        words = requestline.split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            log_access(self.client_address, requestline, None, 400, 0, 0, 0)
+            await self.write_response(text_response(400, "bad request"), "HTTP/1.0", True)
+            return False
+        method, path, version = words
+        headers = http.client.parse_headers(io.BytesIO(header_bytes))
+        
+        # HTTP/1.1 keeps the connection open unless asked not to, and HTTP/1.0 closes it unless asked not to
+        connection = (headers["Connection"] or "").lower()
+        if version == "HTTP/1.0":
+            keep_alive = connection == "keep-alive"
+        else:
+            keep_alive = connection != "close"
+        
+        start = time.perf_counter()
+        self.received = 0
+        if method == "GET":
+            response = await self.run_in_worker(get_response, self.client_address, path, headers)
+        elif method == "POST":
+            response = await self.read_upload(path, version, headers)
+        else:
+            response = text_response(501, "Unsupported method (%r)" % method)
+            response.close = True
+        
+        close = not keep_alive or response.close or response.content_length() is None or draining
+        sent = await self.write_response(response, version, close)
+        seconds = time.perf_counter() - start
+        if method in ("GET", "POST"):
+            metrics.observe_request(method, response.status, seconds, self.received, sent)
+        log_access(self.client_address, requestline, headers, response.status, seconds, self.received, sent)
+        return not close
+    
+    async def read_upload(self, path, version, headers):
+        upload = UploadRequest(self.client_address, path, headers)
+        response = await self.run_in_worker(upload.start)
+        if response is not None:
+            # the body was not read, so the connection can't be used again
+            response.close = True
+            return response
+        
+        # HTTP/1.0 has no 100 Continue; the comparison is the one http.server uses
+        if (headers["Expect"] or "").lower() == "100-continue" and version >= "HTTP/1.1":
+            self.writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        self.received = upload.length
+        
+        remaining = upload.length
+        try:
+            while remaining > 0:
+                chunk = await asyncio.wait_for(self.reader.read(min(upload_chunk_size, remaining)), asyncio_timeout)
+                if not chunk:
+                    raise MalformedUploadException("request body ended %s bytes before Content-Length" % remaining)
+                remaining -= len(chunk)
+                await self.run_in_worker(upload.feed, chunk)
+        except MalformedUploadException as e:
+            return await self.run_in_worker(upload.fail, e)
+        except BaseException:
+            await self.run_in_worker(upload.abort)
+            raise
+        return await self.run_in_worker(upload.finish)
+    
+    # returns the number of body bytes sent
+    async def write_response(self, response, version, close):
+        sent = 0
+        try:
+            lines = ["%s %s %s" % (version, response.status, http.server.BaseHTTPRequestHandler.responses.get(response.status, ("",))[0])]
+            lines.append("Server: %s" % http.server.BaseHTTPRequestHandler.server_version)
+            lines.append("Date: %s" % email.utils.formatdate(usegmt=True))
+            for key, value in response.headers:
+                lines.append("%s: %s" % (key, value))
+            length = response.content_length()
+            if length is not None and response.status != 304 and not any(key == "Content-Length" for key, value in response.headers):
+                lines.append("Content-Length: %s" % length)
+            if close:
+                lines.append("Connection: close")
+            elif version == "HTTP/1.0":
+                lines.append("Connection: keep-alive")
+            head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin1")
+            
+            if response.file is None and response.chunks is None:
+                # small responses go out in one write
+                self.writer.write(head + response.body)
+                sent = len(response.body)
+            else:
+                self.writer.write(head)
+            
+            if response.file is not None:
+                # sendfile for plain sockets; under TLS, asyncio falls back to reading the file in the worker threads
+                await self.writer.drain()
+                sent = await self.loop.sendfile(self.writer.transport, response.file, response.offset, response.count)
+            elif response.chunks is not None:
+                while True:
+                    chunk = await self.run_in_worker(next, response.chunks, None)
+                    if chunk is None:
+                        break
+                    self.writer.write(chunk)
+                    sent += len(chunk)
+                    await self.writer.drain()
+            await self.writer.drain()
+            return sent
+        finally:
+            await self.run_in_worker(response.finish)
+
+# Serves with asyncio on a listening socket that is created up front, so it can be shared by pre-forked processes like LocalPasteServer's.
+class AsyncioServer:
+    def __init__(self, server_address, sock=None):
+        # sock is the listening socket of the process this one replaces
+        self.socket = sock or socket.create_server(server_address, backlog=1024)
+        self.connections = set()
+        self.stopping = None
+    
+    # called by the SIGTERM handler; it might come before the event loop runs
+    def start_draining(self):
+        global draining
+        if draining:
+            return
+        draining = True
+        log("draining: no new connections are accepted, and open ones are closed after their current request")
+        if self.stopping is not None:
+            self.stopping.set()
+    
+    async def serve(self):
+        # disk I/O runs in the worker threads
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(args.workers or None, thread_name_prefix="worker"))
+        self.stopping = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGTERM, self.start_draining)
+        
+        server_args = {}
+        if ssl_context is not None:
+            # the handshakes run on the event loop, so certificates are replaced there too
+            self.loop.add_signal_handler(signal.SIGHUP, reload_certificate)
+            server_args = {"ssl": ssl_context, "ssl_handshake_timeout": asyncio_timeout}
+        
+        async def serve_connection(reader, writer):
+            connection = AsyncioConnection(reader, writer)
+            self.connections.add(connection)
+            try:
+                await connection.serve()
+            finally:
+                self.connections.discard(connection)
+        
+        server = await asyncio.start_server(serve_connection, sock=self.socket, limit=asyncio_max_header_size, **server_args)
+        if not draining:
+            await self.stopping.wait()
+        
+        # like LocalPasteServer.drain()
+        server.close()
+        deadline = time.time() + args.drain_timeout
+        while self.connections and time.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self.connections:
+            logwarn("%s connections were still open after %ss of draining" % (len(self.connections), args.drain_timeout))
+        else:
+            log("drained")
+    
+    def serve_forever(self):
+        asyncio.run(self.serve())
+    
+    def server_close(self):
+        self.socket.close()
+    
+    def shutdown(self):
+        self.server_close()
+
+############################################
+# Draining and re-exec
+############################################
+
+# Set once SIGTERM was received: the process stops accepting connections, and exits after the requests it is handling.
+draining = False
+
+# On SIGUSR2, the server starts a new copy of itself, which inherits the listening socket, so no connection is refused
+# while it starts, and it works after dropping privileges, since the port doesn't have to be bound again. Once the new
+# process is ready, it sends SIGTERM to the old one, which drains. These environment variables tell the new process
+# the file descriptor of the socket and the pid of the old process.
+listen_fd_env = "LOCALPASTE_LISTEN_FD"
+old_server_pid_env = "LOCALPASTE_OLD_PID"
+
+# popped, so that processes started by this one don't see them
+listen_fd = os.environ.pop(listen_fd_env, None)
+old_server_pid = os.environ.pop(old_server_pid_env, None)
+if old_server_pid is not None:
+    old_server_pid = int(old_server_pid)
+    # a SIGUSR2 sent to the new process before it is ready would kill it, and the old one would keep running
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+# the listening socket inherited from the old process, or None
+def inherited_socket():
+    if listen_fd is None:
+        return None
+    log("taking over the listening socket from process %s" % old_server_pid)
+    return socket.socket(fileno=int(listen_fd))
+
+# start a new server process with the same arguments, which takes over the listening socket sock
+def reexec(sock):
+    if draining:
+        return
+    env = dict(os.environ)
+    env[listen_fd_env] = str(sock.fileno())
+    env[old_server_pid_env] = str(os.getpid())
+    try:
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=[sock.fileno()])
+    except OSError as e:
+        logerror("failed to start a new server process: %s" % e)
+        return
+    log("started process %s to take over from this one" % process.pid)
+
+# called by the new process when it is ready to accept connections
+def stop_old_server():
+    if old_server_pid is None:
+        return
+    try:
+        os.kill(old_server_pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+# Runs in each forked child; the child never returns into the parent's code.
+def run_child(server):
+    # the parent handles ctrl+c and tells the children to stop with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # serve_forever returns once the requests are drained, and the process exits through the finally below
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.start_draining())
+    # only the parent starts a new server
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    if ssl_context is not None:
+        signal.signal(signal.SIGHUP, handle_sighup)
+    status = 0
+    try:
+        if args.user:
+            drop_privileges(args.user)
+        start_background_threads()
+        server.serve_forever()
+    except Exception as e:
+        logerror("process %s failed: %s" % (os.getpid(), e))
+        status = 1
+    finally:
+        stop_log_writer()
+        sys.stdout.flush()
+        os._exit(status)
+
+# Pre-fork mode: the listening socket is created once and inherited by every child, and the kernel
+# spreads the accepted connections between them. The parent only supervises and restarts children that die.
+def run_prefork(server):
+    # pid -> slot number, so a replacement child takes over the slot of the one that died
+    children = {}
+    
+    def spawn(slot):
+        global process_slot
+        pid = os.fork()
+        if pid == 0:
+            process_slot = slot
+            run_child(server)
+        children[pid] = slot
+        logdebug("started process %s in slot %s" % (pid, slot))
+    
+    # the parent reloads too, so children started later get the new certificate
+    def handle_sighup(signum, frame):
+        reload_certificate()
+        for pid in children:
+            os.kill(pid, signal.SIGHUP)
+    
+    # the children drain, and the parent exits once they are all gone
+    stopping = False
+    def handle_sigterm(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        log("draining the processes...")
+        server.server_close()
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+    
+    for slot in range(args.processes):
+        spawn(slot)
+    if ssl_context is not None:
+        signal.signal(signal.SIGHUP, handle_sighup)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGUSR2, lambda signum, frame: stopping or reexec(server.socket))
+    stop_old_server()
+    
+    try:
+        while children:
+            pid, status = os.wait()
+            slot = children.pop(pid, None)
+            if slot is None or stopping:
+                continue
+            logwarn("process %s exited with status %s; starting a new one" % (pid, status))
+            spawn(slot)
+        log("all processes have exited")
+    except KeyboardInterrupt:
+        log("Stopping server...")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        server.server_close()
+        raise
         
 def run_server():
+    global ssl_context
     socketserver.ThreadingMixIn.allow_reuse_address = True
 
+    check_layout()
+    if small_store is not None:
+        small_store.create()
+    paste_index.load()
+    expiry_queue.load_journal()
+    if args.dedup:
+        dedup_index.load()
+    if small_store is not None:
+        small_store.close()
+    open_access_log()
+    if args.scheme == "https":
+        ssl_context = make_ssl_context()
+
     try:
-        server = LocalPasteServer((args.listen_address, args.port), LocalPasteHandler)
+        sock = inherited_socket()
+        if args.engine == "asyncio":
+            server = AsyncioServer((args.listen_address, args.port), sock)
+        else:
+            server = LocalPasteServer((args.listen_address, args.port), LocalPasteHandler, sock)
         log("Starting server... hit ctrl+c to exit")
+        if args.processes > 1:
+            run_prefork(server)
+            return
         if args.user:
             drop_privileges(args.user)
+        if ssl_context is not None:
+            signal.signal(signal.SIGHUP, handle_sighup)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.start_draining())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: reexec(server.socket))
+        start_background_threads()
+        stop_old_server()
+        # returns once the requests are drained after a SIGTERM
         server.serve_forever()
-    except KeyboardInterrupt as e:
+        log(paste_cache.stats_str())
+        server.server_close()
+        stop_log_writer()
+    except KeyboardInterrupt:
+        if args.processes > 1:
+            raise
         log("Stopping server...")
+        log(paste_cache.stats_str())
         server.shutdown()
+        stop_log_writer()
         raise
     
-if args.foreground:
+if args.migrate_layout:
+    migrate_layout()
+elif args.bench_generate_name is not None:
+    bench_generate_name(args.bench_generate_name)
+elif args.foreground:
     run_server()
 elif args.daemon:
     print("daemon mode not implemented... use nohup and foreground instead")
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for localpaste
+#
+# To load test the upload and download paths:
+#    ./localpaste_bench.py load --concurrency 16 --requests 2000 --size 4096 --content-type multipart
+# To test a server with other options:
+#    ./localpaste_bench.py load --server-args "--engine asyncio --compress gzip"
+# To test https, with a certificate made like in the localpaste.py error message:
+#    ./localpaste_bench.py load --certfile server.pem
+# To time generate_name against datadirs with many pastes:
+#    ./localpaste_bench.py names --files 10000 100000 1000000
+#
+# Copyright 2015 Peter Maloney
+#
+# License: Version 2 of the GNU GPL or any later version
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import os
+import argparse
+import base64
+import hashlib
+import http.client
+import random
+import shlex
+import shutil
+import signal
+import socket
+import ssl
+import string
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import quote_plus, urlsplit
+
+localpaste = os.path.join(os.path.dirname(os.path.abspath(__file__)), "localpaste.py")
+
+############################################
+# CLI handling
+############################################
+
+parser = argparse.ArgumentParser(description='Benchmarks for the localpaste server.')
+subparsers = parser.add_subparsers(dest='command')
+
+load_parser = subparsers.add_parser('load', help='start a server and measure uploads and downloads')
+load_parser.add_argument('--concurrency', '-c', action='store',
+                   type=int, default=8,
+                   help='number of clients sending requests at the same time (default=8)')
+load_parser.add_argument('--requests', '-n', action='store',
+                   type=int, default=1000,
+                   help='number of pastes uploaded, and then downloaded (default=1000)')
+load_parser.add_argument('--size', action='store',
+                   type=int, nargs='+', default=[4096],
+                   help='paste sizes in bytes; each size is a separate run (default=4096)')
+load_parser.add_argument('--content-type', action='store',
+                   type=str, nargs='+', default=["multipart"], choices=["multipart", "urlencoded"],
+                   help='upload encodings; each one is a separate run (default=multipart)')
+load_parser.add_argument('--server-args', action='store',
+                   type=str, default="",
+                   help='extra command line arguments for localpaste.py, like "--engine asyncio"')
+load_parser.add_argument('--certfile', action='store',
+                   type=str, default=None,
+                   help='run the server with https, using this certificate file (default=http)')
+load_parser.add_argument('--port', action='store',
+                   type=int, default=None,
+                   help='port for the server (default=a free port)')
+
+names_parser = subparsers.add_parser('names', help='time generate_name against datadirs with many pastes')
+names_parser.add_argument('--files', action='store',
+                   type=int, nargs='+', default=[10000, 100000, 1000000],
+                   help='numbers of pastes in the datadir; each one is a separate run (default=10000 100000 1000000)')
+names_parser.add_argument('--calls', action='store',
+                   type=int, default=10000,
+                   help='number of names generated per run (default=10000)')
+names_parser.add_argument('--layout', action='store',
+                   type=str, default="flat", choices=["flat", "sharded"],
+                   help='datadir layout (default=flat)')
+names_parser.add_argument('--name-size', action='store',
+                   type=int, default=6,
+                   help='length of the names of the existing pastes (default=6)')
+
+args = parser.parse_args()
+if args.command is None:
+    parser.print_help()
+    exit(1)
+
+############################################
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[int((len(sorted_values) - 1) * fraction)]
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# peak resident memory in KiB of a process and its children (the --processes children of the server)
+def get_peak_rss(pid):
+    total = 0
+    pids = [pid]
+    try:
+        with open("/proc/%s/task/%s/children" % (pid, pid)) as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open("/proc/%s/status" % p) as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+# A localpaste.py process with its own temp datadir.
+class Server:
+    def __init__(self, port, server_args):
+        self.port = port
+        self.datadir = tempfile.mkdtemp(prefix="localpaste_bench_")
+        command = [sys.executable, localpaste, "--foreground", "--port", str(port), "--listen-address", "127.0.0.1",
+                   "--datadir", self.datadir] + server_args
+        self.log = tempfile.TemporaryFile()
+        # a new session, so ctrl+c in the terminal doesn't hit the server before we are done with it
+        self.process = subprocess.Popen(command, stdout=self.log, stderr=subprocess.STDOUT, start_new_session=True)
+        self.wait_for_port()
+
+    def wait_for_port(self):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                self.log.seek(0)
+                sys.stderr.write(self.log.read().decode("utf-8", "replace"))
+                raise Exception("the server exited with status %s" % self.process.returncode)
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise Exception("the server did not start listening on port %s" % self.port)
+
+    def peak_rss(self):
+        return get_peak_rss(self.process.pid)
+
+    # SIGTERM drains the server, which has no open connections left, so it should be gone quickly; returns False if it wasn't
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        exited = True
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            exited = False
+            # the whole session, so no --processes child is left holding the port
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        shutil.rmtree(self.datadir, ignore_errors=True)
+        return exited
+
+def make_paste(size):
+    # printable, so it can go through both upload encodings, and compresses about like base64-encoded binary files do
+    return base64.b64encode(os.urandom(size))[0:size]
+
+def make_upload(content_type, data):
+    if content_type == "multipart":
+        boundary = "----localpastebench%s" % random.randint(0, 2**32)
+        body = b"".join([
+            b"--", boundary.encode(), b"\r\n",
+            b"Content-Disposition: form-data; name=\"clbin\"\r\n\r\n",
+            data, b"\r\n",
+            b"--", boundary.encode(), b"--\r\n"])
+        return body, "multipart/form-data; boundary=%s" % boundary
+    return b"data=" + quote_plus(data).encode(), "application/x-www-form-urlencoded"
+
+# Send count requests from concurrency threads, each with its own connection, which http.client
+# reopens whenever the server closes it. make_request(n) returns (method, path, body, headers);
+# check(n, status, data) returns an error message or None. Returns (seconds, sorted latencies, errors, bytes).
+def run_requests(port, count, concurrency, make_request, check):
+    latencies = []
+    errors = []
+    transferred = [0]
+    lock = threading.Lock()
+    next_request = [0]
+
+    def worker():
+        if args.certfile:
+            # the certificate is not checked; the clients reuse the TLS session when they reconnect
+            context = ssl._create_unverified_context()
+            conn = http.client.HTTPSConnection("127.0.0.1", port, timeout=60, context=context)
+        else:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        while True:
+            with lock:
+                n = next_request[0]
+                if n >= count:
+                    break
+                next_request[0] += 1
+            method, path, body, headers = make_request(n)
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                if response.will_close:
+                    conn.close()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                with lock:
+                    errors.append(str(e))
+                continue
+            latency = time.perf_counter() - start
+            error = check(n, response.status, data)
+            with lock:
+                latencies.append(latency)
+                transferred[0] += len(data) + len(body or b"")
+                if error:
+                    errors.append(error)
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for n in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return seconds, latencies, errors, transferred[0]
+
+def print_result(label, count, seconds, latencies, errors, transferred):
+    print("%-34s %8.1f req/s %8.2f MiB/s   p50 %7.2f ms   p99 %7.2f ms   max %7.2f ms   errors %s" % (
+        label, count / seconds, transferred / seconds / 1024 / 1024,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, (latencies[-1] if latencies else 0) * 1000,
+        len(errors)))
+    for error in errors[0:3]:
+        print("    %s" % error)
+
+def bench_load():
+    port = args.port or get_free_port()
+    server_args = shlex.split(args.server_args)
+    if args.certfile:
+        server_args += ["--scheme", "https", "--certfile", os.path.abspath(args.certfile)]
+    server = Server(port, server_args)
+    try:
+        print("server: localpaste.py %s" % args.server_args)
+        print("concurrency %s, %s requests per run" % (args.concurrency, args.requests))
+        for content_type in args.content_type:
+            for size in args.size:
+                pastes = [make_paste(size) for n in range(min(args.requests, 100))]
+                uploads = [make_upload(content_type, data) for data in pastes]
+                urls = [None] * args.requests
+
+                def make_post(n):
+                    body, header = uploads[n % len(uploads)]
+                    return "POST", "/", body, {"Content-Type": header, "Host": "127.0.0.1:%s" % port}
+
+                def check_post(n, status, data):
+                    if status != 200:
+                        return "POST: %s %s" % (status, data[0:100])
+                    urls[n] = urlsplit(data.decode("latin1").strip()).path
+                    return None
+
+                def make_get(n):
+                    return "GET", urls[n], None, {}
+
+                def check_get(n, status, data):
+                    if status != 200:
+                        return "GET %s: %s %s" % (urls[n], status, data[0:100])
+                    if data != pastes[n % len(pastes)]:
+                        return "GET %s: wrong content" % urls[n]
+                    return None
+
+                result = run_requests(port, args.requests, args.concurrency, make_post, check_post)
+                print_result("POST %s %s bytes" % (content_type, size), args.requests, *result)
+
+                # only download what was uploaded
+                count = args.requests
+                if None in urls:
+                    count = urls.index(None)
+                result = run_requests(port, count, args.concurrency, make_get, check_get)
+                print_result("GET %s bytes" % size, count, *result)
+        print("server peak RSS: %.1f MiB" % (server.peak_rss() / 1024))
+    finally:
+        if not server.stop():
+            sys.stderr.write("the server did not exit within 5s of SIGTERM\n")
+            exit(1)
+
+def bench_names():
+    alphabet = string.ascii_letters + string.digits
+    for files in args.files:
+        datadir = tempfile.mkdtemp(prefix="localpaste_bench_")
+        try:
+            start = time.time()
+            names = set()
+            while len(names) < files:
+                names.add("".join(random.choices(alphabet, k=args.name_size)))
+            for name in names:
+                if args.layout == "sharded":
+                    # same as paste_path in localpaste.py
+                    h = hashlib.sha1(name.encode("latin1")).hexdigest()
+                    directory = os.path.join(datadir, h[0:2], h[2:4])
+                    os.makedirs(directory, exist_ok=True)
+                    path = os.path.join(directory, name)
+                else:
+                    path = os.path.join(datadir, name)
+                open(path, "wb").close()
+            print("created %s pastes in %.1fs" % (files, time.time() - start))
+
+            command = [sys.executable, localpaste, "--datadir", datadir, "--layout", args.layout,
+                       "--bench-generate-name", str(args.calls)]
+            # the first run reads the datadir and writes its index, and the second one loads the index
+            for label in ["cold", "warm"]:
+                output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True).stdout.decode("utf-8", "replace")
+                for line in output.splitlines():
+                    if line.startswith("names="):
+                        print("    %s %s" % (label, line))
+        finally:
+            shutil.rmtree(datadir, ignore_errors=True)
+
+if args.command == "load":
+    bench_load()
+elif args.command == "names":
+    bench_names()